@@ -1,6 +1,5 @@
 import db
-from db import connect_to_db
-from flask import Flask, request, jsonify, make_response, render_template, send_from_directory
+from flask import Flask, Response, request, jsonify, make_response, render_template, send_from_directory, g, url_for
 from flask_login import LoginManager, UserMixin, current_user
 from db import check_password
 from decouple import config
@@ -9,8 +8,27 @@ from werkzeug.utils import secure_filename
 import os
 import logging
 import jwt
+from functools import partial
+import auth
 from datetime import datetime, timedelta
-from auth import get_user_id_from_jwt
+from auth import token_required, revoke_token
+from cache import response_cache
+import hashlib
+import math
+import image_variants
+import blobstore
+import bulk
+import passwords
+import metrics
+import profiler
+import compress
+import ratelimit
+import sweeper
+import events
+from passwords import login_throttle
+from werkzeug.security import safe_join
+from werkzeug.exceptions import HTTPException, RequestEntityTooLarge, UnsupportedMediaType
+from uploads import UploadRequest, check_image
 from dotenv import load_dotenv
 import logging
 
@@ -24,6 +42,8 @@ print(flask_login_version)
 
 app = Flask(__name__)
 app.debug = True
+# File fields are size- and type-checked as they stream in (see uploads.py)
+app.request_class = UploadRequest
 
 secret_key = config("SECRET_KEY", default="default_secret_key")
 app.secret_key = secret_key
@@ -38,12 +58,64 @@ app.config.update({
     'SESSION_COOKIE_HTTPONLY': True,
     'SESSION_COOKIE_SECURE': False,  # Set to True if using HTTPS
     'SESSION_COOKIE_SAMESITE': 'Lax',
+    # Let Apache/lighttpd (mod_xsendfile) send upload bytes instead of Python
+    'USE_X_SENDFILE': config("USE_X_SENDFILE", default=False, cast=bool),
+    # Bodies declaring more than this are refused before they are read
+    'MAX_CONTENT_LENGTH': config("MAX_CONTENT_LENGTH", default=20 * 1024 * 1024, cast=int),
 })
 
+# nginx equivalent of X-Sendfile: the internal location that maps to uploads/
+X_ACCEL_REDIRECT_PREFIX = config("X_ACCEL_REDIRECT_PREFIX", default="")
+# Cache lifetime for uploads that are not content-addressed (legacy files, variants)
+UPLOADS_MAX_AGE = config("UPLOADS_MAX_AGE", default=3600, cast=int)
+
+db.initial_setup()
+# Reclaims deleted images and unreferenced files in small batches (see sweeper.py)
+sweeper.start_background()
+# Wakes /events streams for changes committed by other worker processes
+events.ChangeRelay(events.broker, db.connection, events.POLL_INTERVAL).start()
+
+metrics.init_app(app)
+profiler.init_app(app)
+# After metrics, so refused requests are still timed and counted
+ratelimit.init_app(app)
+compress.init_app(app)
+
+@metrics.register_collector
+def pool_and_cache_metrics():
+    pool = db.pool.get_stats()
+    cache = response_cache.get_stats()
+    return [
+        ("db_pool_connections", "gauge", "Pooled database connections by state.",
+         [({"state": "open"}, pool["open"]), ({"state": "in_use"}, pool["in_use"]), ({"state": "max"}, pool["size"])]),
+        ("db_pool_events_total", "counter", "Connection pool checkouts, waits for a free connection, and suspected leaks.",
+         [({"event": event}, pool[event]) for event in ("created", "checkouts", "waits", "leaks")]),
+        ("response_cache_requests_total", "counter", "Response cache lookups by result.",
+         [({"result": "hit"}, cache["hits"]), ({"result": "miss"}, cache["misses"])]),
+        ("response_cache_hit_ratio", "gauge", "Share of response cache lookups that were hits.", [({}, cache["hit_rate"])]),
+        ("response_cache_entries", "gauge", "Entries held by the response cache.", [({}, cache["size"])]),
+        ("response_cache_evictions_total", "counter", "Response cache entries evicted for space.", [({}, cache["evictions"])]),
+        ("token_cache_requests_total", "counter", "Verified-token cache lookups by result.",
+         [({"result": "hit"}, auth.token_cache.hits), ({"result": "miss"}, auth.token_cache.misses)]),
+        ("events_subscribers", "gauge", "Open /events streams in this process.", [({}, events.broker.subscriber_count())]),
+    ]
+
 # Initialize the LoginManager
 login_manager = LoginManager(app)
 login_manager.login_view = "login"
 
+@app.errorhandler(RequestEntityTooLarge)
+@app.errorhandler(UnsupportedMediaType)
+def upload_rejected(e):
+    return jsonify({"error": e.description}), e.code
+
+@app.errorhandler(passwords.HashingBusy)
+@app.errorhandler(db.StreamsBusy)
+def server_busy(e):
+    response = jsonify({"error": str(e)})
+    response.headers["Retry-After"] = "1"
+    return response, 503
+
 @app.route('/')
 def home():
     if current_user.is_authenticated:
@@ -51,95 +123,241 @@ def home():
     else:
         return 'Hello, Guest!'
 
+############################# PAGINATION #########################
+
+MAX_PAGE_SIZE = 500
+
+def page_args():
+    # ?limit=50&after_id=123&fields=id,name,thumbnail
+    def positive_int(name):
+        value = request.args.get(name)
+        if value is None:
+            return None
+        if not value.isdigit():
+            raise ValueError(f"{name} must be a non-negative integer")
+        return int(value)
+
+    limit = positive_int("limit")
+    if limit is not None and not 1 <= limit <= MAX_PAGE_SIZE:
+        raise ValueError(f"limit must be between 1 and {MAX_PAGE_SIZE}")
+    fields = request.args.get("fields")
+    fields = [f.strip() for f in fields.split(",") if f.strip()] if fields else None
+    return limit, positive_int("after_id"), fields
+
+def stream_format():
+    # ?stream=1 streams a JSON array; Accept: application/x-ndjson streams one object per line
+    if request.accept_mimetypes.best_match(["application/json", "application/x-ndjson"]) == "application/x-ndjson":
+        return "ndjson"
+    if request.args.get("stream") in ("1", "true"):
+        return "json"
+    return None
+
+def stream_rows(rows, fmt):
+    # Serialize one row at a time so memory stays flat however many rows there are
+    if fmt == "ndjson":
+        for row in rows:
+            yield app.json.dumps(row) + "\n"
+        return
+    yield "["
+    for i, row in enumerate(rows):
+        yield ("," if i else "") + app.json.dumps(row)
+    yield "]"
+
+def paginated_response(fetch, iterate=None):
+    """Run a keyset-paginated db listing and add a Link: rel="next" header when more rows remain.
+
+    If ``iterate`` (the generator form of ``fetch``) is given and the client asked
+    for streaming, rows are written out as they come off the cursor instead.
+    """
+    try:
+        limit, after_id, fields = page_args()
+        fmt = stream_format() if iterate else None
+        if fmt:
+            rows = iterate(limit=limit, after_id=after_id, fields=fields)
+            mimetype = "application/x-ndjson" if fmt == "ndjson" else "application/json"
+            return Response(stream_rows(rows, fmt), mimetype=mimetype)
+        # One extra row tells us whether there is a next page
+        rows = fetch(limit=limit + 1 if limit else None, after_id=after_id, fields=fields)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except db.StreamsBusy as e:
+        # Answered here, since some callers turn any other exception into a 500
+        return server_busy(e)
+    response = jsonify(rows[:limit] if limit else rows)
+    if limit and len(rows) > limit:
+        args = dict(request.args, after_id=rows[limit - 1]["id"])
+        response.headers["Link"] = f'<{url_for(request.endpoint, **(request.view_args or {}), **args)}>; rel="next"'
+    return response
+
+############################# RESPONSE CACHE #########################
+
+def cached_json(key, load):
+    """Serve ``load()`` as JSON through the response cache, answering If-None-Match with 304.
+
+    Returns None when ``load()`` finds nothing (misses are not cached).
+    """
+    entry = response_cache.get(key)
+    if entry is None:
+        generation = response_cache.generation()
+        data = load()
+        if data is None:
+            return None
+        body = app.json.dumps(data)
+        entry = (body, hashlib.sha1(body.encode()).hexdigest())
+        response_cache.set(key, entry, generation)
+    body, etag = entry
+    response = Response(body, mimetype="application/json")
+    response.set_etag(etag)
+    return response.make_conditional(request)
+
 ############################# ITEMS ROUTES #########################
 
 @app.route("/items.json", methods=["GET"])
+@token_required
 def items_index():
     try:
-        # Extract JWT token from the Authorization header
-        auth_header = request.headers.get('Authorization')
-        if auth_header:
-            token = auth_header.split(" ")[1]  # Assuming Bearer token format
-        else:
-            return jsonify({"error": "Authentication token missing"}),  401
-
-        # Decode the JWT token to get the user_id
-        secret_key = app.config['SECRET_KEY']
-        decoded_token = jwt.decode(token, secret_key, algorithms=['HS256'])
-        user_id = decoded_token['user_id']
-
         # Retrieve items associated with the user_id
-        items_data = []
-        for item in db.items_all_for_user(user_id):
-            item_data = db.get_item_with_category_and_images(item["id"])
-            if item_data:
-                items_data.append(item_data)
-
-        return jsonify(items_data)
-    except jwt.ExpiredSignatureError:
-        return jsonify({"error": "Token expired"}),  401
-    except jwt.InvalidTokenError:
-        return jsonify({"error": "Invalid token"}),  401
+        return paginated_response(
+            partial(db.items_all_with_category_and_images_for_user, g.user_id),
+            partial(db.iter_items_with_category_and_images_for_user, g.user_id),
+        )
     except Exception as e:
         return jsonify({"error": str(e)}),  500
 
 @app.route("/items.json", methods=["POST"])
+@token_required
 def item_create():
-    auth_header = request.headers.get('Authorization')
-    if auth_header:
-        if auth_header.startswith('Bearer '):
-            token = auth_header[7:]  # Remove 'Bearer ' prefix
-            
-            # Call the get_user_id_from_jwt function for debugging
-            try:
-                user_id = get_user_id_from_jwt(token)
-                
-                # Log the token after user ID extraction
-                
-                # Extract item data from the request form
-                name = request.form.get("name")
-                brand = request.form.get("brand")
-                size = request.form.get("size")
-                color = request.form.get("color")
-                fit = request.form.get("fit")
-                category_id = request.form.get("category_id")
-                image = request.files.get("image")
-
-                # Ensure that all required fields are provided
-                if not (name and brand and size and color and fit and category_id):
-                    raise ValueError("Missing required fields")
-
-                # Save the image file to a secure location if provided
-                if image:
-                    filename = secure_filename(image.filename)
-                    filepath = os.path.join('uploads', filename)
-                    image.save(filepath)
-                else:
-                    filename = None
-                    filepath = None
-
-                # Create the item in the database
-                db.items_create(name, brand, size, color, fit, category_id, filename, filepath, user_id)
-                # If item creation was successful and an image was provided, associate the image with the item in the database
-                # if item and image:
-                #     db.images_create(filename, item["item_id"])
-
-                return jsonify({"message": "Item created successfully"})
-            except Exception as e:
-                # Handle exceptions
-                return jsonify({"error": str(e)}),   400
+    try:
+        # Extract item data from the request form
+        name = request.form.get("name")
+        brand = request.form.get("brand")
+        size = request.form.get("size")
+        color = request.form.get("color")
+        fit = request.form.get("fit")
+        category_id = request.form.get("category_id")
+        image = request.files.get("image")
+
+        # Ensure that all required fields are provided
+        if not (name and brand and size and color and fit and category_id):
+            raise ValueError("Missing required fields")
+
+        # Save the image file to a secure location if provided
+        if image:
+            check_image(image)
+            filename, filepath = db.store_upload(image)
         else:
-            return jsonify({"error": "Invalid Authorization header format"}),   401
+            filename = None
+            filepath = None
+
+        # Create the item in the database
+        item = db.items_create(name, brand, size, color, fit, category_id, filename, filepath, g.user_id)
+        if item and item.get("image") and filepath:
+            image_variants.schedule(item["image"]["id"], filepath)
+        # If item creation was successful and an image was provided, associate the image with the item in the database
+        # if item and image:
+        #     db.images_create(filename, item["item_id"])
+
+        return jsonify({"message": "Item created successfully"})
+    except HTTPException:
+        raise
+    except Exception as e:
+        # Handle exceptions
+        return jsonify({"error": str(e)}),   400
+
+
+@app.route("/items/search")
+@token_required
+def items_search():
+    # ?q=blue jea&limit=20&offset=0&fields=id,name,thumbnail -- prefix matches, best first
+    query = request.args.get("q", "")
+    try:
+        limit, _, fields = page_args()
+        limit = limit or 20
+        offset = int(request.args.get("offset", 0))
+        if offset < 0:
+            raise ValueError("offset must be a non-negative integer")
+        # One extra row tells us whether there is a next page
+        rows = db.items_search(g.user_id, query, limit=limit + 1, offset=offset, fields=fields)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    response = jsonify(rows[:limit])
+    if len(rows) > limit:
+        args = dict(request.args, offset=offset + limit)
+        response.headers["Link"] = f'<{url_for("items_search", **args)}>; rel="next"'
+    return response
+
+@app.route("/items/facets")
+@token_required
+def items_facets():
+    # ?category=Shoes&brand=HOPE&brand=COS&limit=50&after_id=123&fields=... -- the
+    # filtered items plus per-facet counts, so the closet view needs one request
+    filters = {facet: request.args.getlist(facet) for facet in db.FACET_COLUMNS if facet in request.args}
+    try:
+        limit, after_id, fields = page_args()
+        # One extra row tells us whether there is a next page
+        rows = db.items_all_with_category_and_images_for_user(
+            g.user_id, limit=limit + 1 if limit else None, after_id=after_id, fields=fields, filters=filters
+        )
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    response = jsonify(dict(db.items_facets(g.user_id, filters), items=rows[:limit] if limit else rows))
+    if limit and len(rows) > limit:
+        args = dict(request.args.lists(), after_id=rows[limit - 1]["id"])
+        response.headers["Link"] = f'<{url_for("items_facets", **args)}>; rel="next"'
+    return response
+
+BULK_MAX_CONTENT_LENGTH = config("BULK_MAX_CONTENT_LENGTH", default=500 * 1024 * 1024, cast=int)
+UploadRequest.data_upload_endpoints.add("items_bulk_import")
+
+@app.route("/items/bulk", methods=["POST"])
+@token_required
+def items_bulk_import():
+    """Import items from CSV or NDJSON.
+
+    Send either a multipart "file" field (plus an optional "images" zip whose
+    members the rows name in their "image" column) or a raw text/csv or
+    application/x-ndjson body. ?format= overrides detection.
+    """
+    request.max_content_length = BULK_MAX_CONTENT_LENGTH
+    upload = request.files.get("file")
+    if upload:
+        stream, fmt = upload.stream, bulk.detect_format(upload.filename, upload.mimetype)
     else:
-        return jsonify({"error": "Authentication token missing"}),   401
+        stream, fmt = request.stream, bulk.detect_format(None, request.content_type)
+    fmt = request.args.get("format") or fmt
+    if fmt not in ("csv", "ndjson"):
+        return jsonify({"error": "Send a CSV or NDJSON file, or pass ?format=csv|ndjson"}), 400
+
+    categories = {category["category_name"]: category["id"] for category in db.categories_all()}
+    try:
+        rows, errors = bulk.prepare_rows(bulk.read_records(stream, fmt), categories, request.files.get("images"))
+    except (UnicodeDecodeError, bulk.zipfile.BadZipFile, bulk.csv.Error) as e:
+        return jsonify({"error": f"Could not read import: {e}"}), 400
+    created = db.items_bulk_create(rows, g.user_id)
+    for (item_id, image_id), row in zip(created, rows):
+        if image_id:
+            image_variants.schedule(image_id, row[7])
+    return jsonify({"imported": len(created), "item_ids": [item_id for item_id, _ in created], "errors": errors})
+
+@app.route("/items/bulk", methods=["GET"])
+@token_required
+def items_bulk_export():
+    # ?format=ndjson (default) or csv; streamed straight from the cursor
+    fmt = request.args.get("format", "ndjson")
+    items = db.iter_items_with_category_and_images_for_user(g.user_id)
+    if fmt == "csv":
+        return Response(bulk.export_csv(items), mimetype="text/csv", headers={"Content-Disposition": "attachment; filename=closet.csv"})
+    if fmt == "ndjson":
+        return Response(stream_rows(items, "ndjson"), mimetype="application/x-ndjson", headers={"Content-Disposition": "attachment; filename=closet.ndjson"})
+    return jsonify({"error": "format must be csv or ndjson"}), 400
 
 
 @app.route("/items/<id>.json")
 def item_show(id):
     try:
-        item_data = db.get_item_with_category_and_images(id)
-        if item_data:
-            return jsonify(item_data)
+        response = cached_json(db.item_cache_key(id), lambda: db.get_item_with_category_and_images(id))
+        if response:
+            return response
         else:
             return jsonify({"error": "Item not found"}),  404
     except Exception as e:
@@ -147,17 +365,9 @@ def item_show(id):
 
 
 @app.route("/items/<id>.json", methods=["PATCH"])
+@token_required
 def item_update(id):
     logger.debug(f"Received PATCH request for item ID: {id}")
-    auth_header = request.headers.get('Authorization')
-    if auth_header:
-        token = auth_header.split(" ")[1]  # Assuming Bearer token format
-    else:
-        logger.warning("Authentication token missing")
-        return jsonify({"error": "Authentication token missing"}),  401
-
-    # Extract user_id from the JWT token
-    user_id = get_user_id_from_jwt(token)
     try:
         
         name = request.form.get("name")
@@ -168,13 +378,19 @@ def item_update(id):
         category_id = request.form.get("category_id")
 
         image = request.files.get("image")
+        if image:
+            check_image(image)
         # Call the items_update_by_id function with the provided parameters
         updated_item = db.items_update_by_id(id, name, brand, size, color, fit, category_id, image)
         
         if updated_item:
+            if updated_item["image"]:
+                image_variants.schedule(updated_item["image"]["id"], updated_item["image"]["filepath"])
             return jsonify({"message": "Item updated successfully"})
         else:
             return jsonify({"error": "Failed to update item"}), 500
+    except HTTPException:
+        raise
     except Exception as e:
         # Handle exceptions
         return jsonify({"error": str(e)}), 500
@@ -185,11 +401,52 @@ def item_destroy(id):
     return db.items_destroy_by_id(id)
 
 
+############################# SYNC ROUTES ######################
+
+@app.route("/sync")
+@token_required
+def sync():
+    # ?since=<version from the last sync>&limit=500 -- only what changed since
+    # then: upserted items (with their images) and categories, plus deleted ids.
+    # Keep calling with the returned version while "more" is true.
+    since = request.args.get("since", "0")
+    try:
+        if not since.isdigit():
+            raise ValueError("since must be a non-negative integer")
+        limit, _, _ = page_args()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify(db.sync_changes(g.user_id, int(since), limit))
+
+@app.route("/events")
+@token_required
+def events_stream():
+    # Server-sent "change" events carrying the same deltas as /sync; the SSE
+    # id is the version, so EventSource's Last-Event-ID resumes a dropped
+    # stream. Under a WSGI server each open stream holds a worker thread;
+    # asgi.py runs it on the event loop instead.
+    last_event_id = request.headers.get("Last-Event-ID")
+    if last_event_id is not None and not last_event_id.isdigit():
+        return jsonify({"error": "Last-Event-ID must be a version from this stream"}), 400
+    stream = events.EventStream(
+        g.user_id,
+        int(last_event_id) if last_event_id is not None else None,
+        partial(db.sync_changes, g.user_id, limit=events.BATCH_SIZE),
+        db.sync_version,
+    )
+    request.environ[events.EventStream.ENVIRON_KEY] = stream
+    return Response(
+        stream,
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 ############################# CATEGORY ROUTES ######################
 
 @app.route("/categories.json")
 def category_index():
-    return db.categories_all()
+    return cached_json("categories", db.categories_all)
 
 
 @app.route("/categories.json", methods=["POST"])
@@ -224,13 +481,13 @@ class User(UserMixin):
         return f'<User id={self.id}, email={self.email}>'
 
 @app.route("/users.json")
+@token_required
 def users_index():
-    users = db.get_all_users()
-    return jsonify(users)
+    return paginated_response(db.get_all_users)
 
 @login_manager.user_loader
 def load_user(user_id):
-    print(f"Loading User: {user_id}")
+    logger.debug("Loading user %s", user_id)
     user_data = db.get_user_by_id(user_id)
     return User(user_data) if user_data else None
 
@@ -254,8 +511,7 @@ def generate_jwt_token(user_id):
         "user_id": user_id,
         "exp": datetime.utcnow() + timedelta(days=1)  # Token expires in  1 day
     }
-    secret_key = app.config['SECRET_KEY']
-    return jwt.encode(payload, secret_key, algorithm='HS256')
+    return jwt.encode(payload, auth.SECRET_KEY, algorithm='HS256')
 
 @app.route("/login", methods=["GET", "POST"])
 def login():
@@ -268,31 +524,44 @@ def login():
         email = data.get("email")
         password = data.get("password")
 
+        # Refuse a throttled email or client before spending any hashing time on it
+        throttle_keys = [
+            (f"email:{(email or '').lower()}", passwords.LOGIN_MAX_FAILURES_PER_EMAIL),
+            (f"ip:{request.remote_addr}", passwords.LOGIN_MAX_FAILURES_PER_IP),
+        ]
+        retry_after = max(login_throttle.retry_after(key, limit) for key, limit in throttle_keys)
+        if retry_after:
+            response = make_response({"message": "Too many failed login attempts, try again later"}, 429)
+            response.headers["Retry-After"] = str(math.ceil(retry_after))
+            return response
+
         user = db.get_user_by_email(email)
 
-        if user and check_password(password, user["password"]):
+        # Checked even for an unknown email, so timing does not reveal which emails exist
+        if check_password(password, user["password"] if user else None):
+            login_throttle.reset(throttle_keys[0][0])
+            if passwords.needs_rehash(user["password"]):
+                passwords.rehash_later(password, partial(db.update_user_password, user["id"]))
             user_obj = User(user)
             # login_user(user_obj)  # Comment out this line if you're using JWT
-            print(f"Current User: {user_obj}")
+            logger.debug("Logged in user %s", user_obj.id)
             
             token = generate_jwt_token(user_obj.id)
             response = make_response({"message": "Login successful", "token": token})
-            print("Response headers:", dict(response.headers))
-            
             return response  # No need to manually set the cookie
         else:
+            for key, _ in throttle_keys:
+                login_throttle.failed(key)
             return {"message": "Invalid email or password"},   401
 
     return render_template('login.html')
 
 
 
-blacklisted_tokens = set()
-
 @app.route("/logout", methods=["POST"])
+@token_required
 def logout():
-    token = request.headers.get('Authorization').split()[1]
-    blacklisted_tokens.add(token)
+    revoke_token(g.token)
     return jsonify({"message": "Logout successful"})
 
 ############################# IMAGES ROUTES ######################
@@ -300,51 +569,44 @@ def logout():
 
 logging.basicConfig(level=logging.INFO)
 
-def allowed_file(filename):
-    """Check if the given filename has an allowed extension."""
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in {'png', 'jpg', 'jpeg', 'gif'}
-
 @app.route("/images.json")
 def image_index():
-    return db.images_all()
+    return paginated_response(db.images_all, db.iter_images)
 
 def image_create(filename, item_id):
-    try:
-        conn = connect_to_db()
+    with db.connection() as conn:
+        try:
+            cursor = conn.execute(
+                """
+                INSERT INTO images (filename, filepath, item_id)
+                VALUES (?, ?, ?)
+                RETURNING *
+                """,
+                (filename, os.path.join('uploads', filename), item_id),
+            )
+
+            inserted_row = cursor.fetchone()
+            conn.commit()
+            return dict(inserted_row) if inserted_row else None
+        except Exception as e:
+            logging.error(f"Error inserting image into database: {e}")
+            conn.rollback()  # Roll back the transaction in case of error
+            return None
+
+
+def get_item_with_category_and_images(item_id):
+    with db.connection() as conn:
         cursor = conn.execute(
             """
-            INSERT INTO images (filename, filepath, item_id)
-            VALUES (?, ?, ?)
-            RETURNING *
+            SELECT items.*, categories.category_name, images.filename, images.filepath
+            FROM items
+            JOIN categories ON items.category_id = categories.id
+            LEFT JOIN images ON items.id = images.item_id
+            WHERE items.id = ?
             """,
-            (filename, os.path.join('uploads', filename), item_id),
+            (item_id,),
         )
-
-        inserted_row = cursor.fetchone()
-        conn.commit()
-        return dict(inserted_row) if inserted_row else None
-    except Exception as e:
-        logging.error(f"Error inserting image into database: {e}")
-        conn.rollback()  # Roll back the transaction in case of error
-        return None
-    finally:
-        conn.close()
-
-
-def get_item_with_category_and_images(item_id):
-    conn = connect_to_db()
-    cursor = conn.execute(
-        """
-        SELECT items.*, categories.category_name, images.filename, images.filepath
-        FROM items
-        JOIN categories ON items.category_id = categories.id
-        LEFT JOIN images ON items.id = images.item_id
-        WHERE items.id = ?
-        """,
-        (item_id,),
-    )
-    row = cursor.fetchone()
-    conn.close()
+        row = cursor.fetchone()
     if row:
         item_with_images = dict(row)
         # Remove the individual filename and filepath keys from the dictionary
@@ -361,7 +623,48 @@ def image_destroy(id):
 
 @app.route('/uploads/<path:filename>')
 def serve_image(filename):
-    logging.info("Serving image: %s", filename)
+    logging.debug("Serving image: %s", filename)
     # Assuming images are stored in a folder named 'uploads' in your project directory
     uploads_folder = 'uploads'
-    return send_from_directory(os.path.abspath(uploads_folder), filename)
\ No newline at end of file
+    # ?size=thumb|medium|webp serves a pre-rendered variant when one exists
+    size = request.args.get("size")
+    # The original standing in for a variant that is not rendered yet
+    fallback = False
+    if size:
+        if size not in image_variants.VARIANT_NAMES:
+            return jsonify({"error": f"Unknown size: {size}"}), 400
+        variant = db.image_variant_path(os.path.join(uploads_folder, filename), size)
+        if variant:
+            filename = os.path.relpath(variant, uploads_folder)
+        else:
+            fallback = True
+
+    # Blobs are named by their SHA-256, so they can never change: cache them
+    # forever and use the digest as a strong ETag. Not so for a fallback: the
+    # URL asks for a variant, and must pick it up once it is rendered.
+    immutable = blobstore.is_blob(os.path.join(uploads_folder, filename)) and not fallback
+    digest = os.path.splitext(os.path.basename(filename))[0] if immutable else None
+
+    if X_ACCEL_REDIRECT_PREFIX:
+        if not os.path.isfile(safe_join(os.path.abspath(uploads_folder), filename) or ""):
+            return jsonify({"error": "Image not found"}), 404
+        response = make_response("")
+        response.headers["X-Accel-Redirect"] = X_ACCEL_REDIRECT_PREFIX.rstrip("/") + "/" + filename
+        response.headers["Content-Type"] = ""  # let nginx pick it from the file
+    else:
+        # send_file handles If-None-Match / If-Modified-Since / Range, and hands
+        # the file to wsgi.file_wrapper (sendfile) or X-Sendfile when available
+        response = send_from_directory(
+            os.path.abspath(uploads_folder),
+            filename,
+            etag=digest or True,
+            max_age=31536000 if immutable else UPLOADS_MAX_AGE,
+        )
+    response.cache_control.public = True
+    if immutable:
+        response.cache_control.max_age = 31536000
+        response.cache_control.immutable = True
+    elif fallback:
+        response.cache_control.max_age = None
+        response.cache_control.no_cache = True
+    return response
\ No newline at end of file
@@ -0,0 +1,240 @@
+# asgi.py
+# ASGI entry point serving the same Flask routes as app.py. The event loop
+# holds the connections, reads request bodies and writes responses; a request
+# only takes a worker thread once its body has fully arrived, and gives the
+# thread back between response chunks. Slow uploads, slow downloads and idle
+# keep-alive connections therefore cost no threads, so one process can hold
+# thousands of them. /events streams likewise wait for changes on the loop,
+# so an idle subscriber costs no thread either.
+# Usage: uvicorn asgi:application   (or any other ASGI server)
+import asyncio
+import logging
+import sys
+import tempfile
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from decouple import config
+from werkzeug.exceptions import HTTPException
+from app import app, BULK_MAX_CONTENT_LENGTH
+import events
+import uploads
+
+# Threads running views and database calls; requests beyond this wait on the loop
+ASGI_WORKERS = config("ASGI_WORKERS", default=32, cast=int)
+# Endpoints that accept bodies past MAX_CONTENT_LENGTH, and their limit
+LARGE_BODY_ENDPOINTS = {"items_bulk_import": BULK_MAX_CONTENT_LENGTH}
+RESPONSE_CHUNK_SIZE = 64 * 1024
+
+_executor = ThreadPoolExecutor(max_workers=ASGI_WORKERS, thread_name_prefix="asgi-worker")
+
+
+class _FileWrapper:
+    # wsgi.file_wrapper: files are read one block per worker hop instead of
+    # being pushed out by a thread that waits for the client
+    def __init__(self, file, block_size=RESPONSE_CHUNK_SIZE):
+        self.file = file
+        self.block_size = block_size
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        data = self.file.read(self.block_size)
+        if not data:
+            raise StopIteration
+        return data
+
+    def close(self):
+        self.file.close()
+
+
+class _BodyTooLarge(Exception):
+    pass
+
+
+def _body_limit(scope):
+    """The largest body the endpoint ``scope`` routes to accepts.
+
+    Found before any of the body is read, so /login and the like never spool
+    more than MAX_CONTENT_LENGTH; Flask still applies its own limits after.
+    """
+    try:
+        endpoint, _ = app.url_map.bind_to_environ(_environ(scope, None, 0)).match()
+    except HTTPException:
+        endpoint = None  # 404, 405 or a redirect: Flask answers without the body
+    return LARGE_BODY_ENDPOINTS.get(endpoint, app.config["MAX_CONTENT_LENGTH"])
+
+
+async def _read_body(receive, loop, limit):
+    """Spool the request body; only the part past UPLOAD_SPOOL_THRESHOLD is written to disk, off the loop.
+
+    Returns (file, size), or (None, size) if the client went away first.
+    """
+    body = tempfile.SpooledTemporaryFile(max_size=uploads.UPLOAD_SPOOL_THRESHOLD)
+    size = 0
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            body.close()
+            return None, size
+        chunk = message.get("body", b"")
+        size += len(chunk)
+        if size > limit:
+            body.close()
+            raise _BodyTooLarge()
+        if chunk:
+            if size > uploads.UPLOAD_SPOOL_THRESHOLD:
+                await loop.run_in_executor(_executor, body.write, chunk)
+            else:
+                body.write(chunk)
+        if not message.get("more_body", False):
+            body.seek(0)
+            return body, size
+
+
+def _environ(scope, body, size):
+    server = scope.get("server") or ("localhost", 80)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope["query_string"].decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": "HTTP/" + scope.get("http_version", "1.1"),
+        "CONTENT_LENGTH": str(size),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": body,
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False,
+        "wsgi.file_wrapper": _FileWrapper,
+    }
+    if scope.get("client"):
+        environ["REMOTE_ADDR"], environ["REMOTE_PORT"] = scope["client"][0], str(scope["client"][1])
+    for name, value in scope["headers"]:
+        name = name.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+        if name == "CONTENT_LENGTH":
+            continue  # the spooled size is authoritative
+        key = name if name == "CONTENT_TYPE" else "HTTP_" + name
+        environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+async def _send_error(send, status, message):
+    body = app.json.dumps({"error": message}).encode()
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+async def _wait_for_disconnect(receive):
+    while (await receive())["type"] != "http.disconnect":
+        pass
+
+
+async def _stream_events(stream, started, receive, send, loop):
+    # The steps of events.EventStream.__iter__, waiting on the loop instead
+    # of in a thread; only the database reads go to a worker.
+    woken = asyncio.Event()
+    wake = functools.partial(loop.call_soon_threadsafe, woken.set)
+    events.broker.subscribe(stream.user_id, wake)
+    disconnected = asyncio.ensure_future(_wait_for_disconnect(receive))
+    try:
+        # Subscribed before reading, so a commit in between still wakes us
+        since = stream.since if stream.since is not None else await loop.run_in_executor(_executor, stream.current_version)
+        await send({"type": "http.response.start", "status": started["status"], "headers": started["headers"]})
+        await send({"type": "http.response.body", "body": events.opening(since).encode(), "more_body": True})
+        while True:
+            frames, since = await loop.run_in_executor(_executor, events.drain, stream.load_changes, since)
+            if frames:
+                await send({"type": "http.response.body", "body": "".join(frames).encode(), "more_body": True})
+            while not woken.is_set():
+                waiting = asyncio.ensure_future(woken.wait())
+                done, _ = await asyncio.wait({waiting, disconnected}, timeout=events.HEARTBEAT_INTERVAL, return_when=asyncio.FIRST_COMPLETED)
+                if disconnected in done:
+                    waiting.cancel()
+                    return
+                if waiting not in done:
+                    waiting.cancel()
+                    await send({"type": "http.response.body", "body": events.HEARTBEAT.encode(), "more_body": True})
+            woken.clear()
+    except OSError:
+        pass  # the client went away mid-send
+    finally:
+        events.broker.unsubscribe(stream.user_id, wake)
+        disconnected.cancel()
+
+
+async def _http(scope, receive, send):
+    loop = asyncio.get_running_loop()
+    headers = dict(scope["headers"])
+    declared = headers.get(b"content-length")
+    limit = _body_limit(scope)
+    # Refuse from the header alone, before reading any of the body
+    if declared and declared.isdigit() and int(declared) > limit:
+        return await _send_error(send, 413, f"Request body exceeds the {limit} byte limit")
+    try:
+        body, size = await _read_body(receive, loop, limit)
+    except _BodyTooLarge:
+        return await _send_error(send, 413, f"Request body exceeds the {limit} byte limit")
+    if body is None:
+        return
+
+    started = {}
+
+    def start_response(status, response_headers, exc_info=None):
+        if exc_info and started.get("sent"):
+            raise exc_info[1].with_traceback(exc_info[2])
+        started["status"] = int(status.split(" ", 1)[0])
+        started["headers"] = [(k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in response_headers]
+
+    environ = _environ(scope, body, size)
+    result = await loop.run_in_executor(_executor, app, environ, start_response)
+    stream = environ.get(events.EventStream.ENVIRON_KEY)
+    if stream is not None and started.get("status") == 200:
+        # The view has authenticated and set the headers; the unstarted
+        # response iterator is dropped without ever subscribing
+        result.close()
+        body.close()
+        return await _stream_events(stream, started, receive, send, loop)
+    chunks = iter(result)
+    try:
+        # Pull the first chunk before sending headers: start_response may be deferred until then
+        chunk = await loop.run_in_executor(_executor, next, chunks, None)
+        started["sent"] = True
+        await send({"type": "http.response.start", "status": started["status"], "headers": started["headers"]})
+        while chunk is not None:
+            if chunk:
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+            chunk = await loop.run_in_executor(_executor, next, chunks, None)
+        await send({"type": "http.response.body", "body": b""})
+    finally:
+        if hasattr(result, "close"):
+            await loop.run_in_executor(_executor, result.close)
+        body.close()
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            _executor.shutdown(wait=True)
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def application(scope, receive, send):
+    if scope["type"] == "http":
+        return await _http(scope, receive, send)
+    if scope["type"] == "lifespan":
+        return await _lifespan(receive, send)
+    logging.warning("Unsupported ASGI scope type: %s", scope["type"])
@@ -1,18 +1,118 @@
 import jwt
-import os
 import logging
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from decouple import config
+from flask import request, jsonify, g
+import db
+from revocation import RevocationStore
 
-def get_user_id_from_jwt(token):
-    # Retrieve the secret key from the environment variable
-    secret_key = os.environ.get('SECRET_KEY')
+# Same key app.py signs tokens with
+SECRET_KEY = config("SECRET_KEY", default="default_secret_key")
+
+# Shared with every worker through the database; see revocation.py
+revoked_tokens = RevocationStore(
+    db.connection,
+    refresh_interval=config("REVOCATION_REFRESH_INTERVAL", default=5.0, cast=float),
+)
+
+
+class TokenCache:
+    """Bounded LRU of verified tokens: token -> (user_id, expires_at).
+
+    An entry is dropped once the token's own ``exp`` passes or after ``ttl``
+    seconds, whichever comes first.
+    """
+
+    def __init__(self, maxsize=1024, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, token):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is None or entry[1] <= now:
+                self._entries.pop(token, None)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(token)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, token, user_id, exp):
+        expires_at = min(exp, time.time() + self.ttl) if exp else time.time() + self.ttl
+        with self._lock:
+            self._entries[token] = (user_id, expires_at)
+            self._entries.move_to_end(token)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def discard(self, token):
+        with self._lock:
+            self._entries.pop(token, None)
+
+
+token_cache = TokenCache(
+    maxsize=config("JWT_CACHE_SIZE", default=1024, cast=int),
+    ttl=config("JWT_CACHE_TTL", default=300, cast=int),
+)
 
+
+def verify_token(token):
+    # Returns the user_id for a valid token, raising jwt.InvalidTokenError (or a subclass) otherwise
+    if revoked_tokens.is_revoked(token):
+        raise jwt.InvalidTokenError("Token has been revoked")
+    user_id = token_cache.get(token)
+    if user_id is not None:
+        return user_id
+    decoded_token = jwt.decode(token, SECRET_KEY, algorithms=['HS256'])
+    user_id = decoded_token.get('user_id')
+    token_cache.put(token, user_id, decoded_token.get('exp'))
+    return user_id
+
+
+def revoke_token(token):
+    # The row only has to outlive the token itself
+    exp = jwt.decode(token, SECRET_KEY, algorithms=['HS256'], options={"verify_exp": False}).get('exp')
+    revoked_tokens.revoke(token, exp or time.time() + 86400)
+    token_cache.discard(token)
+
+
+def token_required(f):
+    """Authenticate the Bearer token and expose it as g.token and its user as g.user_id."""
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        auth_header = request.headers.get('Authorization')
+        if not auth_header:
+            return jsonify({"error": "Authentication token missing"}), 401
+        if not auth_header.startswith('Bearer '):
+            return jsonify({"error": "Invalid Authorization header format"}), 401
+        token = auth_header[7:]  # Remove 'Bearer ' prefix
+        try:
+            g.user_id = verify_token(token)
+        except jwt.ExpiredSignatureError:
+            return jsonify({"error": "Token expired"}), 401
+        except jwt.InvalidTokenError:
+            return jsonify({"error": "Invalid token"}), 401
+        g.token = token
+        return f(*args, **kwargs)
+    return decorated
+
+
+def get_user_id_from_jwt(token):
     # Log the token before attempting to decode it
     # logging.info(f"Attempting to decode token: {token}")
 
     try:
-        # Decode the JWT token with the secret key and specified algorithm
-        decoded_token = jwt.decode(token, secret_key, algorithms=['HS256'])
-        user_id = decoded_token.get('user_id')
+        # Verify the token (served from the cache when it was checked recently)
+        user_id = verify_token(token)
         # logging.info(f"Token decoded successfully. User ID: {user_id}")
         # logging.info(f"token: {token}")
         return user_id
@@ -31,4 +131,4 @@ def get_user_id_from_jwt(token):
     except Exception as e:
         # Catch any other unexpected exceptions
         logging.error(f"An unexpected error occurred: {str(e)}")
-        
+
@@ -0,0 +1,336 @@
+# benchmark.py
+# Seeds a throwaway database with synthetic users, categories, items and
+# images, drives the API with concurrent clients, and prints throughput and
+# p50/p95/p99 latencies per operation as JSON. Usage:
+#   python benchmark.py [--items 10000] [--users 100] [--concurrency 8] [--seconds 20]
+#                       [--mix login=1,list=10,show=10,create=2,update=2,image=5]
+#                       [--server none|wsgi|asgi] [--output result.json]
+#                       [--baseline previous.json --tolerance 0.25]
+# With --baseline, exits non-zero when any operation's p95 grew, or its
+# throughput fell, by more than the tolerance.
+import argparse
+import http.client
+import io
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import urlencode
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--users", type=int, default=100)
+parser.add_argument("--categories", type=int, default=10)
+parser.add_argument("--items", type=int, default=10000)
+parser.add_argument("--image-ratio", type=float, default=0.5, help="share of items that have an image")
+parser.add_argument("--distinct-images", type=int, default=50)
+parser.add_argument("--image-kb", type=int, default=64)
+parser.add_argument("--concurrency", type=int, default=8)
+parser.add_argument("--seconds", type=float, default=20)
+parser.add_argument("--mix", default="login=1,list=10,show=10,create=2,update=2,image=5")
+parser.add_argument("--server", choices=["none", "wsgi", "asgi"], default="none",
+                    help="none drives the app in-process; wsgi/asgi start a local server and use HTTP")
+parser.add_argument("--port", type=int, default=8799)
+parser.add_argument("--seed", type=int, default=42)
+parser.add_argument("--output")
+parser.add_argument("--baseline")
+parser.add_argument("--tolerance", type=float, default=0.25)
+args = parser.parse_args()
+
+MIX = {op: float(weight) for op, weight in (part.split("=") for part in args.mix.split(","))}
+PASSWORD = "benchmark-password"
+REPO = os.path.dirname(os.path.abspath(__file__))
+
+OUTPUT = os.path.abspath(args.output) if args.output else None
+BASELINE = os.path.abspath(args.baseline) if args.baseline else None
+
+# Everything (database, uploads/) lives in a temp dir; the app resolves both relative to the cwd
+tmpdir = tempfile.mkdtemp(prefix="closet-bench-")
+os.chdir(tmpdir)
+sys.path.insert(0, REPO)
+os.environ["DATABASE"] = os.path.join(tmpdir, "bench.db")
+os.environ.setdefault("DB_POOL_SIZE", str(max(5, args.concurrency)))
+# Every simulated user comes from one address, so per-IP limits would measure
+# the rate limiter rather than the app; set these to benchmark with limits on
+for group in ("AUTH", "WRITES", "READS", "IMAGES"):
+    os.environ.setdefault(f"RATE_LIMIT_{group}", "0")
+
+import blobstore  # noqa: E402  (db and friends read their settings at import time)
+import db  # noqa: E402
+import passwords  # noqa: E402
+
+SIZES = ["XS", "S", "M", "L", "XL", "28", "30", "32", "34", "9", "10", "11"]
+COLORS = ["Black", "White", "Navy", "Grey", "Olive", "Blue", "Red", "Cream"]
+FITS = ["slim", "regular", "relaxed", "oversized"]
+BRANDS = [f"Brand {i}" for i in range(40)]
+WORDS = ["Oxford", "Denim", "Linen", "Wool", "Chore", "Field", "Cargo", "Crew", "Henley", "Parka", "Loafer", "Runner"]
+PNG_HEADER = bytes.fromhex(
+    "89504e470d0a1a0a0000000d4948445200000001000000010806000000"
+    "1f15c4890000000d49444154789c6360000002000001e221bc330000000049454e44ae426082"
+)
+
+
+def seed(rng):
+    started = time.perf_counter()
+    db.initial_setup()
+    # One hash shared by every user keeps seeding fast; logins still pay the full check
+    hashed = passwords.hash_password(PASSWORD)
+    emails = [f"user{i}@bench.test" for i in range(args.users)]
+    with db.connection() as conn:
+        conn.executemany("INSERT INTO users (email, password) VALUES (?, ?)", [(email, hashed) for email in emails])
+        conn.executemany("INSERT INTO categories (category_name) VALUES (?)",
+                         [(f"Category {i}",) for i in range(args.categories)])
+        conn.commit()
+        user_ids = [conn.execute("SELECT id FROM users WHERE email = ?", (email,)).fetchone()["id"] for email in emails]
+        category_ids = [row["id"] for row in conn.execute("SELECT id FROM categories ORDER BY id")]
+
+    # Distinct padded PNGs, stored the way uploads are
+    images = []
+    for i in range(args.distinct_images):
+        data = PNG_HEADER + rng.randbytes(max(0, args.image_kb * 1024 - len(PNG_HEADER)))
+        _, filepath = blobstore.store(io.BytesIO(data), ".png")
+        images.append((f"image{i}.png", filepath))
+
+    items_by_user = {}
+    per_user = [args.items // args.users + (1 if i < args.items % args.users else 0) for i in range(args.users)]
+    for user_id, count in zip(user_ids, per_user):
+        rows = []
+        for _ in range(count):
+            filename, filepath = rng.choice(images) if rng.random() < args.image_ratio else (None, None)
+            rows.append((f"{rng.choice(WORDS)} {rng.choice(WORDS)}", rng.choice(BRANDS), rng.choice(SIZES),
+                         rng.choice(COLORS), rng.choice(FITS), rng.choice(category_ids), filename, filepath))
+        items_by_user[user_id] = [item_id for item_id, _ in db.items_bulk_create(rows, user_id)]
+    return {
+        "users": user_ids,
+        "emails": dict(zip(user_ids, emails)),
+        "categories": category_ids,
+        "items_by_user": items_by_user,
+        "image_paths": [os.path.relpath(filepath, "uploads") for _, filepath in images],
+        "seconds": round(time.perf_counter() - started, 2),
+    }
+
+
+############################# CLIENTS #########################
+
+class InProcessClient:
+    def __init__(self, flask_app):
+        self.client = flask_app.test_client()
+
+    def request(self, method, path, form=None, headers=None):
+        response = self.client.open(path, method=method, data=form, headers=headers)
+        body = response.get_data()
+        return response.status_code, body
+
+
+class HTTPClient:
+    # One keep-alive connection per worker
+    def __init__(self, port):
+        self.port = port
+        self.conn = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+
+    def request(self, method, path, form=None, headers=None):
+        headers = dict(headers or {})
+        body = None
+        if form is not None:
+            body = urlencode(form)
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+        try:
+            self.conn.request(method, path, body=body, headers=headers)
+            response = self.conn.getresponse()
+        except (http.client.HTTPException, OSError):
+            self.conn.close()
+            self.conn = http.client.HTTPConnection("127.0.0.1", self.port, timeout=60)
+            raise
+        return response.status, response.read()
+
+
+def start_server():
+    env = dict(os.environ, PYTHONPATH=REPO + os.pathsep + os.environ.get("PYTHONPATH", ""))
+    if args.server == "asgi":
+        command = [sys.executable, "-m", "uvicorn", "asgi:application", "--port", str(args.port), "--log-level", "warning"]
+    else:
+        command = [sys.executable, "-c",
+                   f"import logging, app; logging.disable(logging.INFO); app.app.run(port={args.port}, threaded=True, debug=False, use_reloader=False)"]
+    server = subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", args.port), timeout=1).close()
+            return server
+        except OSError:
+            if server.poll() is not None:
+                raise SystemExit(f"{args.server} server exited with status {server.returncode}")
+            time.sleep(0.1)
+    server.kill()
+    raise SystemExit(f"{args.server} server did not start on port {args.port}")
+
+
+############################# OPERATIONS #########################
+
+def random_item(rng, data):
+    return {
+        "name": f"{rng.choice(WORDS)} {rng.choice(WORDS)}", "brand": rng.choice(BRANDS), "size": rng.choice(SIZES),
+        "color": rng.choice(COLORS), "fit": rng.choice(FITS), "category_id": rng.choice(data["categories"]),
+    }
+
+
+def run_operation(op, client, rng, data, tokens):
+    user_id = rng.choice(data["users"])
+    auth = {"Authorization": f"Bearer {tokens[user_id]}"}
+    items = data["items_by_user"][user_id]
+    if op == "login":
+        return client.request("POST", "/login", form={"email": data["emails"][user_id], "password": PASSWORD})
+    if op == "list":
+        return client.request("GET", "/items.json?limit=50", headers=auth)
+    if op == "show":
+        return client.request("GET", f"/items/{rng.choice(items)}.json" if items else "/items/1.json")
+    if op == "create":
+        return client.request("POST", "/items.json", headers=auth, form=random_item(rng, data))
+    if op == "update":
+        # PATCH replaces every column, so send a whole item
+        return client.request("PATCH", f"/items/{rng.choice(items)}.json" if items else "/items/1.json", headers=auth,
+                              form=random_item(rng, data))
+    if op == "image":
+        return client.request("GET", f"/uploads/{rng.choice(data['image_paths'])}")
+    raise ValueError(f"Unknown operation: {op}")
+
+
+def percentile(sorted_values, fraction):
+    # Nearest-rank percentile of an already sorted list
+    if not sorted_values:
+        return None
+    index = max(0, min(len(sorted_values) - 1, int(round(fraction * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+def summarize(samples, elapsed):
+    operations = {}
+    for op, results in sorted(samples.items()):
+        latencies = sorted(latency for latency, _ in results)
+        statuses = {}
+        for _, status in results:
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+        operations[op] = {
+            "count": len(results),
+            # A status is an HTTP code, or the exception the client raised
+            "errors": sum(1 for _, status in results if not isinstance(status, int) or status >= 400),
+            "statuses": statuses,
+            "throughput_rps": round(len(results) / elapsed, 1),
+            "mean_ms": round(sum(latencies) / len(latencies) * 1000, 3),
+            "p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+            "p95_ms": round(percentile(latencies, 0.95) * 1000, 3),
+            "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+            "max_ms": round(latencies[-1] * 1000, 3),
+        }
+    total = sum(o["count"] for o in operations.values())
+    return {
+        "requests": total,
+        "errors": sum(o["errors"] for o in operations.values()),
+        "throughput_rps": round(total / elapsed, 1),
+        "operations": operations,
+    }
+
+
+def compare(result, baseline, tolerance):
+    # Returns human-readable regressions against a previous run's JSON
+    regressions = []
+    for op, current in result["operations"].items():
+        previous = baseline.get("operations", {}).get(op)
+        if not previous:
+            continue
+        if current["p95_ms"] > previous["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{op}: p95 {previous['p95_ms']} ms -> {current['p95_ms']} ms")
+        if current["throughput_rps"] < previous["throughput_rps"] * (1 - tolerance):
+            regressions.append(f"{op}: throughput {previous['throughput_rps']} -> {current['throughput_rps']} req/s")
+    return regressions
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    rng = random.Random(args.seed)
+    print(f"Seeding {args.items} items for {args.users} users in {tmpdir}", file=sys.stderr)
+    data = seed(rng)
+
+    import logging
+    logging.disable(logging.INFO)
+    import app  # noqa: E402  (runs initial_setup against the seeded database)
+
+    # Tokens are minted directly: logging every user in first would cost one
+    # full password hash each. The "login" operation still measures /login.
+    # The id is a string, as in the tokens /login issues (User.id).
+    tokens = {user_id: app.generate_jwt_token(str(user_id)) for user_id in data["users"]}
+
+    server = None
+    if args.server == "none":
+        make_client = lambda: InProcessClient(app.app)  # noqa: E731
+    else:
+        server = start_server()
+        make_client = lambda: HTTPClient(args.port)  # noqa: E731
+
+    try:
+        ops, weights = list(MIX), list(MIX.values())
+        samples = {op: [] for op in ops}
+        lock = threading.Lock()
+        deadline = time.monotonic() + args.seconds
+
+        def worker(number):
+            client = make_client()
+            worker_rng = random.Random(args.seed * 1000 + number)
+            local = {op: [] for op in ops}
+            while time.monotonic() < deadline:
+                op = worker_rng.choices(ops, weights)[0]
+                started = time.perf_counter()
+                try:
+                    status, _ = run_operation(op, client, worker_rng, data, tokens)
+                except Exception as e:
+                    status = type(e).__name__
+                local[op].append((time.perf_counter() - started, status))
+            with lock:
+                for op, results in local.items():
+                    samples[op].extend(results)
+
+        started = time.perf_counter()
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(args.concurrency)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - started
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+
+    result = {
+        "commit": git_commit(),
+        "config": {k: v for k, v in vars(args).items() if k not in ("output", "baseline")},
+        "seed_seconds": data["seconds"],
+        "duration_seconds": round(elapsed, 2),
+        **summarize({op: s for op, s in samples.items() if s}, elapsed),
+    }
+    output = json.dumps(result, indent=2)
+    if OUTPUT:
+        with open(OUTPUT, "w") as out:
+            out.write(output + "\n")
+    print(output)
+
+    if BASELINE:
+        with open(BASELINE) as f:
+            regressions = compare(result, json.load(f), args.tolerance)
+        for line in regressions:
+            print("REGRESSION", line, file=sys.stderr)
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
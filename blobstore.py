@@ -0,0 +1,134 @@
+# blobstore.py
+# Content-addressed storage for uploads. A file lives at
+#   uploads/blobs/<h[0:2]>/<h[2:4]>/<sha256><ext>
+# so identical uploads share one copy and different files never collide,
+# whatever they were called on the client.
+import hashlib
+import io
+import logging
+import os
+import tempfile
+
+BLOB_ROOT = os.path.join('uploads', 'blobs')
+CHUNK_SIZE = 64 * 1024
+
+
+def blob_path(digest, extension=""):
+    return os.path.join(BLOB_ROOT, digest[:2], digest[2:4], digest + extension.lower())
+
+
+def is_blob(filepath):
+    return bool(filepath) and os.path.normpath(filepath).startswith(BLOB_ROOT + os.sep)
+
+
+class SpooledBlob:
+    """Writable upload target that hashes bytes as they arrive.
+
+    Data stays in memory up to ``threshold`` bytes, then moves to a temp file
+    inside BLOB_ROOT, so ``commit()`` can rename it into place without copying.
+    ``check`` is called with each chunk before it is accepted and may raise to
+    abort the upload.
+    """
+
+    def __init__(self, threshold=1024 * 1024, check=None):
+        self.threshold = threshold
+        self.check = check
+        self.size = 0
+        self._sha = hashlib.sha256()
+        self._buffer = io.BytesIO()
+        self._file = None
+        self._tmp_path = None
+
+    def write(self, chunk):
+        if self.check:
+            self.check(self, chunk)
+        self._sha.update(chunk)
+        self.size += len(chunk)
+        if self._file is None and self.size > self.threshold:
+            os.makedirs(BLOB_ROOT, exist_ok=True)
+            fd, self._tmp_path = tempfile.mkstemp(dir=BLOB_ROOT, prefix=".upload-")
+            self._file = os.fdopen(fd, "w+b")
+            self._file.write(self._buffer.getvalue())
+            self._buffer = None
+        return (self._file or self._buffer).write(chunk)
+
+    def read(self, size=-1):
+        return (self._file or self._buffer).read(size)
+
+    def readline(self, size=-1):
+        return (self._file or self._buffer).readline(size)
+
+    def seek(self, offset, whence=0):
+        return (self._file or self._buffer).seek(offset, whence)
+
+    def tell(self):
+        return (self._file or self._buffer).tell()
+
+    def commit(self, extension=""):
+        digest = self._sha.hexdigest()
+        filepath = blob_path(digest, extension)
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        if self._file is None:
+            # Small upload: write the in-memory bytes to a temp file first so the final rename is still atomic
+            os.makedirs(BLOB_ROOT, exist_ok=True)
+            fd, self._tmp_path = tempfile.mkstemp(dir=BLOB_ROOT, prefix=".upload-")
+            self._file = os.fdopen(fd, "w+b")
+            self._file.write(self._buffer.getvalue())
+            self._buffer = None
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        os.replace(self._tmp_path, filepath)
+        self._tmp_path = None
+        return digest, filepath
+
+    def close(self):
+        # Discard anything that was never committed
+        if self._file is not None and not self._file.closed:
+            self._file.close()
+        if self._tmp_path and os.path.exists(self._tmp_path):
+            os.remove(self._tmp_path)
+        self._tmp_path = None
+
+
+def store(stream, extension=""):
+    """Copy ``stream`` into the store, hashing it on the way. Returns (digest, filepath)."""
+    if isinstance(stream, SpooledBlob):
+        return stream.commit(extension)
+    os.makedirs(BLOB_ROOT, exist_ok=True)
+    sha = hashlib.sha256()
+    fd, tmp_path = tempfile.mkstemp(dir=BLOB_ROOT, prefix=".upload-")
+    try:
+        with os.fdopen(fd, "wb") as out:
+            while True:
+                chunk = stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                sha.update(chunk)
+                out.write(chunk)
+        digest = sha.hexdigest()
+        filepath = blob_path(digest, extension)
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        # Replace even when the blob exists: the rename is atomic, and it
+        # re-creates a copy a concurrent release() may have just removed.
+        os.replace(tmp_path, filepath)
+        return digest, filepath
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def release(filepath, references):
+    """Delete a blob once ``references`` (rows still pointing at it) is zero. Returns True if removed.
+
+    Files outside the blob store (legacy uploads) are never touched.
+    """
+    if references or not is_blob(filepath):
+        return False
+    try:
+        os.remove(filepath)
+    except FileNotFoundError:
+        return False
+    logging.info("Reclaimed blob %s", filepath)
+    return True
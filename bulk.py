@@ -0,0 +1,121 @@
+# bulk.py
+# Closet import/export in CSV or NDJSON. An import may come with a zip of
+# images referenced by each row's "image" column.
+import csv
+import io
+import json
+import os
+import zipfile
+from werkzeug.utils import secure_filename
+import blobstore
+import uploads
+
+REQUIRED_COLUMNS = ["name", "brand", "size", "color", "fit"]
+EXPORT_COLUMNS = ["id", "name", "brand", "size", "color", "fit", "category_id", "category_name", "image"]
+
+
+def detect_format(filename, content_type):
+    filename = (filename or "").lower()
+    content_type = (content_type or "").lower()
+    if filename.endswith(".csv") or "csv" in content_type:
+        return "csv"
+    if filename.endswith((".ndjson", ".jsonl")) or "ndjson" in content_type or "jsonl" in content_type:
+        return "ndjson"
+    return None
+
+
+def read_records(stream, fmt):
+    """Yield (line number, record dict or None, error or None) from a CSV/NDJSON byte stream."""
+    text = io.TextIOWrapper(stream, encoding="utf-8", newline="")
+    if fmt == "csv":
+        reader = csv.DictReader(text)
+        for record in reader:
+            yield reader.line_num, record, None
+        return
+    for line_no, line in enumerate(text, start=1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            yield line_no, None, f"Invalid JSON: {e}"
+            continue
+        if not isinstance(record, dict):
+            yield line_no, None, "Each line must be a JSON object"
+            continue
+        yield line_no, record, None
+
+
+def _store_zip_image(archive, name):
+    # Stream one zip member into the blob store after checking it is an image
+    try:
+        info = archive.getinfo(name)
+    except KeyError:
+        raise ValueError(f"Image {name!r} is not in the zip")
+    if info.file_size > uploads.MAX_UPLOAD_SIZE:
+        raise ValueError(f"Image {name!r} exceeds the {uploads.MAX_UPLOAD_SIZE} byte limit")
+    with archive.open(info) as member:
+        if uploads.sniff(member.read(uploads.SNIFF_BYTES)) is None:
+            raise ValueError(f"{name!r} is not a PNG, JPEG, GIF or WebP image")
+    filename = secure_filename(os.path.basename(name))
+    with archive.open(info) as member:
+        _, filepath = blobstore.store(member, os.path.splitext(filename)[1])
+    return filename, filepath
+
+
+def prepare_rows(records, categories, images_zip=None):
+    """Validate parsed records into db.items_bulk_create rows.
+
+    ``categories`` maps category_name -> id. Returns (rows, errors), where each
+    error is {"row": line number, "error": message}.
+    """
+    archive = zipfile.ZipFile(images_zip) if images_zip else None
+    category_ids = set(categories.values())
+    rows, errors = [], []
+    for line_no, record, error in records:
+        if error:
+            errors.append({"row": line_no, "error": error})
+            continue
+        record = {k: (str(v).strip() if v is not None else "") for k, v in record.items() if k}
+        missing = [c for c in REQUIRED_COLUMNS if not record.get(c)]
+        if missing:
+            errors.append({"row": line_no, "error": f"Missing required fields: {', '.join(missing)}"})
+            continue
+        category_id = record.get("category_id")
+        if category_id:
+            if not category_id.isdigit() or int(category_id) not in category_ids:
+                errors.append({"row": line_no, "error": f"Unknown category_id: {category_id}"})
+                continue
+            category_id = int(category_id)
+        else:
+            category_id = categories.get(record.get("category_name"))
+            if category_id is None:
+                errors.append({"row": line_no, "error": f"Unknown category: {record.get('category_name')!r}"})
+                continue
+        filename = filepath = None
+        if record.get("image"):
+            if archive is None:
+                errors.append({"row": line_no, "error": "Row names an image but no images zip was sent"})
+                continue
+            try:
+                filename, filepath = _store_zip_image(archive, record["image"])
+            except (ValueError, zipfile.BadZipFile) as e:
+                errors.append({"row": line_no, "error": str(e)})
+                continue
+        rows.append((record["name"], record["brand"], record["size"], record["color"], record["fit"], category_id, filename, filepath))
+    return rows, errors
+
+
+def export_csv(items):
+    # Yields CSV text one item at a time; "image" is the item's first image filename
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=EXPORT_COLUMNS, extrasaction="ignore")
+    writer.writeheader()
+    for item in items:
+        writer.writerow(dict(item, image=(item.get("filenames") or [""])[0]))
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    remainder = buffer.getvalue()
+    if remainder:
+        yield remainder
@@ -0,0 +1,70 @@
+import threading
+import time
+from collections import OrderedDict
+from decouple import config
+
+
+class LRUCache:
+    """Size-bounded LRU cache whose entries also expire after ``ttl`` seconds.
+
+    ``generation()`` and ``set(..., generation=...)`` close the read-through
+    race: a value loaded before an invalidation is never stored after it.
+    """
+
+    def __init__(self, maxsize=1024, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = 0
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+
+    def get(self, key):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] <= now:
+                self._entries.pop(key, None)
+                self.stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return entry[0]
+
+    def generation(self):
+        return self._generation
+
+    def set(self, key, value, generation=None):
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.stats["evictions"] += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            self._generation += 1
+            self.stats["invalidations"] += 1
+            self._entries.pop(key, None)
+
+    def invalidate_prefix(self, prefix):
+        with self._lock:
+            self._generation += 1
+            self.stats["invalidations"] += 1
+            for key in [k for k in self._entries if k.startswith(prefix)]:
+                del self._entries[key]
+
+    def get_stats(self):
+        with self._lock:
+            lookups = self.stats["hits"] + self.stats["misses"]
+            return dict(self.stats, size=len(self._entries), hit_rate=self.stats["hits"] / lookups if lookups else 0.0)
+
+
+# Serialized JSON bodies for the read-mostly endpoints, keyed "categories" and "item:<id>"
+response_cache = LRUCache(
+    maxsize=config("RESPONSE_CACHE_SIZE", default=1024, cast=int),
+    ttl=config("RESPONSE_CACHE_TTL", default=60, cast=float),
+)
@@ -0,0 +1,119 @@
+# compress.py
+# Negotiated response compression. Bodies of a compressible type and at least
+# COMPRESS_MIN_SIZE bytes are encoded with the best of zstd, brotli and gzip
+# that both the client (Accept-Encoding) and this install support. Encoded
+# bodies are cached by ETag, so an unchanged hot payload -- a cached item, the
+# category list, an SVG from uploads/ -- is compressed once, not per request.
+# Responses without an ETag get one from a hash of their body, which is far
+# cheaper than compressing it again and also lets clients revalidate with 304.
+import gzip
+from decouple import config
+from flask import request
+from cache import LRUCache
+import metrics
+
+try:
+    import brotli
+except ImportError:  # optional; gzip is always available
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:  # optional; gzip is always available
+    zstandard = None
+
+# Smaller bodies fit in a packet or two anyway and are sent as they are
+COMPRESS_MIN_SIZE = config("COMPRESS_MIN_SIZE", default=1024, cast=int)
+# Files served from uploads/ larger than this are streamed uncompressed
+COMPRESS_MAX_FILE_SIZE = config("COMPRESS_MAX_FILE_SIZE", default=4 * 1024 * 1024, cast=int)
+COMPRESS_LEVEL = config("COMPRESS_LEVEL", default=6, cast=int)
+
+COMPRESSIBLE_TYPES = {
+    "application/json",
+    "application/javascript",
+    "application/xml",
+    "image/svg+xml",
+}
+
+# Server preference, best first, for encodings the client rates equally
+CODECS = {}
+if zstandard is not None:
+    CODECS["zstd"] = lambda data: zstandard.ZstdCompressor(level=COMPRESS_LEVEL).compress(data)
+if brotli is not None:
+    CODECS["br"] = lambda data: brotli.compress(data, quality=min(COMPRESS_LEVEL, 11))
+CODECS["gzip"] = lambda data: gzip.compress(data, compresslevel=COMPRESS_LEVEL, mtime=0)
+
+# (encoding, ETag) -> encoded body
+compressed_cache = LRUCache(
+    maxsize=config("COMPRESS_CACHE_SIZE", default=256, cast=int),
+    ttl=config("COMPRESS_CACHE_TTL", default=3600, cast=float),
+)
+
+compressed = metrics.register(metrics.Counter(
+    "http_compressed_responses_total", "Compressed responses by encoding and whether the encoded body was cached.",
+    ["encoding", "cache"],
+))
+
+
+def compressible(response):
+    return response.mimetype in COMPRESSIBLE_TYPES or response.mimetype.startswith("text/")
+
+
+def _body(response):
+    """The full body as bytes, or None when it should go out as it is."""
+    if response.direct_passthrough:
+        # A file from send_file: small enough ones are read, bigger ones keep streaming
+        if response.content_length is None or response.content_length > COMPRESS_MAX_FILE_SIZE:
+            return None
+        response.direct_passthrough = False
+        return response.get_data()
+    if response.is_streamed:
+        return None  # generators (?stream=1, /events) are written as they are produced
+    return response.get_data()
+
+
+def init_app(app):
+    """Compress eligible responses for clients that accept it."""
+
+    @app.after_request
+    def compress_response(response):
+        if (
+            response.status_code != 200
+            or "Content-Encoding" in response.headers
+            or "X-Sendfile" in response.headers
+            or "X-Accel-Redirect" in response.headers
+            or not compressible(response)
+        ):
+            return response
+        response.vary.add("Accept-Encoding")
+        if response.content_length is not None and response.content_length < COMPRESS_MIN_SIZE:
+            return response
+        encoding = request.accept_encodings.best_match(list(CODECS))
+        if encoding is None:
+            return response
+        data = _body(response)
+        if data is None or len(data) < COMPRESS_MIN_SIZE:
+            return response
+
+        etag, weak = response.get_etag()
+        if etag is None:
+            response.add_etag()
+            response.make_conditional(request)
+            if response.status_code != 200:
+                return response
+            etag, weak = response.get_etag()
+        key = f"{encoding}:{etag}"
+        body = compressed_cache.get(key)
+        compressed.inc(encoding=encoding, cache="hit" if body is not None else "miss")
+        if body is None:
+            body = CODECS[encoding](data)
+            compressed_cache.set(key, body)
+
+        response.set_data(body)
+        response.headers["Content-Encoding"] = encoding
+        # Byte ranges would refer to the encoded body; clients get it whole instead
+        response.headers.pop("Accept-Ranges", None)
+        # Weak, since the bytes differ from the identity encoding's; If-None-Match
+        # compares weakly, so the plain ETag still revalidates to a 304
+        response.set_etag(etag, weak=True)
+        return response
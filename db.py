@@ -1,173 +1,222 @@
 import sqlite3
-from werkzeug.security import generate_password_hash, check_password_hash
+import re
+import functools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 import logging
 from werkzeug.utils import secure_filename
 import os
 import jwt
 from datetime import datetime, timedelta
-from auth import get_user_id_from_jwt
-
+from decouple import config
+from pool import ConnectionPool
+from cache import response_cache
+import metrics
+import blobstore
+import events
+import migrations
+import passwords
+
+DATABASE = config("DATABASE", default="database.db")
+
+# Pragmas applied to every new connection. WAL lets readers keep going while a
+# write is in progress, and busy_timeout makes writers wait instead of failing
+# with "database is locked".
+STORAGE_PROFILE = {
+    "journal_mode": config("DB_JOURNAL_MODE", default="WAL"),
+    "synchronous": config("DB_SYNCHRONOUS", default="NORMAL"),
+    "cache_size": config("DB_CACHE_SIZE", default=-16000, cast=int),  # negative = KiB
+    "mmap_size": config("DB_MMAP_SIZE", default=134217728, cast=int),
+    "temp_store": config("DB_TEMP_STORE", default="MEMORY"),
+    "busy_timeout": config("DB_BUSY_TIMEOUT", default=5000, cast=int),  # milliseconds
+}
 
 
 def connect_to_db():
-    conn = sqlite3.connect("database.db")
+    # Pooled connections are handed between threads, one at a time
+    # InstrumentedConnection feeds per-query timings and row counts to /metrics
+    conn = sqlite3.connect(
+        DATABASE,
+        timeout=STORAGE_PROFILE["busy_timeout"] / 1000,
+        check_same_thread=False,
+        factory=metrics.InstrumentedConnection,
+    )
     conn.row_factory = sqlite3.Row
+    apply_storage_profile(conn, STORAGE_PROFILE)
     return conn
 
 
-def initial_setup():
-    conn = connect_to_db()
-    # conn.execute(
-    #     """
-    #     DROP TABLE IF EXISTS images
-    #     """
-    # )
-    conn.execute(
-        """
-        CREATE TABLE IF NOT EXISTS categories (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            category_name TEXT UNIQUE NOT NULL
-        );
-        """
-    )
-    # conn.execute("ALTER TABLE items RENAME TO items_old;")
+def apply_storage_profile(conn, profile):
+    for pragma, value in profile.items():
+        conn.execute(f"PRAGMA {pragma} = {value}")
 
-# Step  2: Create a new table with the foreign key constraint
-    conn.execute(
-        """
-        CREATE TABLE IF NOT EXISTS items (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT,
-            brand TEXT,
-            size TEXT,
-            color TEXT,
-            fit TEXT,
-            category_id INT,
-            user_id INT,
-            FOREIGN KEY (category_id) REFERENCES categories (id),
-            FOREIGN KEY (user_id) REFERENCES users (id)
-        );
-        """
-    )
 
-    # Step  3: Copy the data from the old table to the new table
-    # conn.execute(
-    #     """
-    #     INSERT INTO items (id, name, brand, size, color, fit, category_id)
-    #     SELECT id, name, brand, size, color, fit, category_id FROM items_old;
-    #     """
-    # )
-
-    # Step  4: Drop the old table
-    conn.execute("DROP TABLE items_old;")
-#     conn.execute(
-#     """
-#     CREATE TABLE users (
-#         id INTEGER PRIMARY KEY AUTOINCREMENT,
-#         email TEXT UNIQUE NOT NULL,
-#         password TEXT NOT NULL
-#     );
-#     """
-# )
-    
-    # conn.execute(
-    #     """
-    #     CREATE TABLE images (
-    #        id INTEGER PRIMARY KEY AUTOINCREMENT,
-    #         filename TEXT,
-    #         filepath TEXT,
-    #         item_id INT,
-    #         FOREIGN KEY (item_id) REFERENCES items (id)
-    #   );
-    #     """
-    # )
-
-    conn.execute(
-      """
-      ALTER TABLE IF NOT users
-      ADD COLUMN new_column_name column_type;
-      """
-    )
+pool = ConnectionPool(
+    connect_to_db,
+    size=config("DB_POOL_SIZE", default=5, cast=int),
+    timeout=config("DB_POOL_TIMEOUT", default=30.0, cast=float),
+    leak_timeout=config("DB_POOL_LEAK_TIMEOUT", default=60.0, cast=float),
+)
+
+
+def connection():
+    return pool.connection()
+
+
+STREAM_CHUNK_SIZE = config("DB_STREAM_CHUNK_SIZE", default=500, cast=int)
+
+
+# A streamed response keeps reading until the client has taken the whole
+# body, so it gets a connection of its own instead of a pooled one: slow
+# clients cannot starve other requests. This caps how many are open at once.
+MAX_STREAMS = config("DB_MAX_STREAMS", default=16, cast=int)
+_stream_slots = threading.BoundedSemaphore(MAX_STREAMS)
+
+
+class StreamsBusy(Exception):
+    """Raised when DB_MAX_STREAMS streamed reads are already open."""
+
+
+class RowStream:
+    """Rows of one query, fetched a chunk at a time on a dedicated connection.
+
+    The connection is closed and the stream slot freed once the rows run out,
+    on close(), or when the stream is dropped without being read.
+    """
+
+    def __init__(self, conn, cursor, chunk_size):
+        self._conn = conn
+        self._cursor = cursor
+        self._chunk_size = chunk_size
+        self._rows = iter(())
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        for row in self._rows:
+            return row
+        if self._conn is None:
+            raise StopIteration
+        rows = self._cursor.fetchmany(self._chunk_size)
+        if not rows:
+            self.close()
+            raise StopIteration
+        self._rows = iter(rows)
+        return next(self._rows)
+
+    def close(self):
+        if self._conn is not None:
+            conn, self._conn = self._conn, None
+            conn.close()
+            _stream_slots.release()
+
+    __del__ = close
+
+
+def _pooled_rows(sql, params, chunk_size):
+    with connection() as conn:
+        cursor = conn.execute(sql, params)
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield from rows
+
+
+def iter_rows(sql, params=(), chunk_size=None, stream=True):
+    """Iterate the rows of ``sql`` one fetchmany() chunk at a time.
+
+    With ``stream`` the query runs now on a dedicated connection (StreamsBusy
+    if DB_MAX_STREAMS are open); otherwise it borrows a pooled connection,
+    for callers that read every row straight away.
+    """
+    chunk_size = chunk_size or STREAM_CHUNK_SIZE
+    if not stream:
+        return _pooled_rows(sql, params, chunk_size)
+    if not _stream_slots.acquire(blocking=False):
+        raise StreamsBusy("Too many streamed responses in progress, try again shortly")
+    conn = None
+    try:
+        conn = connect_to_db()
+        cursor = conn.execute(sql, params)
+    except BaseException:
+        if conn is not None:
+            conn.close()
+        _stream_slots.release()
+        raise
+    return RowStream(conn, cursor, chunk_size)
+
+
+# Optional single writer: with DB_WRITE_QUEUE=true every write below runs on
+# one dedicated thread, so writers never contend with each other for the lock.
+_write_queue = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer") if config("DB_WRITE_QUEUE", default=False, cast=bool) else None
+
+
+def serialized_write(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        # Writes issued from the writer thread itself run inline, or they would deadlock
+        if _write_queue is None or threading.current_thread().name.startswith("db-writer"):
+            return func(*args, **kwargs)
+        return _write_queue.submit(func, *args, **kwargs).result()
+    return wrapper
+
+
+def item_cache_key(item_id):
+    # Routes pass the id as text; "007", "7" and 7 are one item, so one key
+    item_id = str(item_id)
+    return f"item:{int(item_id)}" if item_id.isdigit() else f"item:{item_id}"
+
+
+def invalidate_item(item_id):
+    response_cache.invalidate(item_cache_key(item_id))
+
+
+def invalidate_categories():
+    # Every cached item embeds its category_name
+    response_cache.invalidate("categories")
+    response_cache.invalidate_prefix("item:")
+
 
-    
-    
-    conn.commit()
-    print("Tables created successfully")
-
-    # categories_seed_data = [
-    # ("Shirts",),
-    # ("Pants",),
-    # ("Sweaters",),
-    # ("Sweatpants",),
-    # ("Shoes",),
-    # ("Accessories",),
-    # ("Jackets",),
-    # ("Suits + Blazers",),
-    # ("Sneakers",)
-    # ]
-
-    # conn.executemany(
-    #     """
-    #     INSERT INTO categories (category_name)
-    #     VALUES (?)
-    #     """,
-    #     categories_seed_data
-    # )
-    # conn.commit()
-    # print("Cateogry seed data created successfully")
-
-
-
-    # items_seed_data = [
-    #     ("Loose-fit Jeans", "HOPE", 34, "Mid Grey Stone", "very baggy", 2),
-    # ]
-    # conn.executemany(
-    #     """
-    #     INSERT INTO items (name, brand, size, color, fit, category_id)
-    #     VALUES (?,?,?,?,?,?)
-    #     """,
-    #     items_seed_data,
-    # )
-    # conn.commit()
-    # print("Seed data created successfully")
-    
-    # images_seed_data = [
-    #     ("https://www.birkenstock.com/on/demandware.static/-/Sites-master-catalog/default/dwb9806ae3/560771/560771_pair.jpg", 2),
-    # ]
-    # conn.executemany(
-    #     """
-    #     INSERT INTO images (filename, filepath, item_id) VALUES (?,?,?);"
-    #     """,
-    #     images_seed_data,
-    # )
-    # conn.commit()
-    # print("Seed data created successfully")
-
-    conn.close()
+def store_upload(image):
+    # Save an uploaded FileStorage into the blob store; returns (filename, filepath)
+    filename = secure_filename(image.filename)
+    _, filepath = blobstore.store(image.stream, os.path.splitext(filename)[1])
+    return filename, filepath
+
+
+def initial_setup():
+    # Bring the schema up to date; safe to run on every start
+    with connection() as conn:
+        version = migrations.migrate(conn)
+    logging.info("Database schema at version %s", version)
+    return version
 
 def reset_items_table():
-    conn = connect_to_db()
-    conn.execute(
-        """
-        DROP TABLE IF EXISTS items;
-        """
-    )
-    conn.execute(
-        """
-        CREATE TABLE items (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT,
-            brand TEXT,
-            size TEXT,  -- Change size column to TEXT
-            color TEXT,
-            fit TEXT,
-            category_id INT,
-            FOREIGN KEY (category_id) REFERENCES categories (id)
-        );
-        """
-    )
-    conn.commit()
-    print("Items table reset successfully")
+    with connection() as conn:
+        conn.execute(
+            """
+            DROP TABLE IF EXISTS items;
+            """
+        )
+        conn.execute(
+            """
+            CREATE TABLE items (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                name TEXT,
+                brand TEXT,
+                size TEXT,  -- Change size column to TEXT
+                color TEXT,
+                fit TEXT,
+                category_id INT,
+                FOREIGN KEY (category_id) REFERENCES categories (id)
+            );
+            """
+        )
+        conn.commit()
+        print("Items table reset successfully")
 
 
 if __name__ == "__main__":
@@ -176,8 +225,10 @@ if __name__ == "__main__":
 ############################### ITEMS #########################
 
 def items_all():
-    conn = connect_to_db()
-    rows = conn.execute(
+    return list(iter_items_all(stream=False))
+
+def iter_items_all(stream=True):
+    rows = iter_rows(
         """
         SELECT items.id, items.name, items.brand, items.size, items.color, items.fit, items.category_id, categories.category_name,
                GROUP_CONCAT(images.filepath) AS filepaths
@@ -185,299 +236,653 @@ def items_all():
         LEFT JOIN categories ON items.category_id = categories.id
         LEFT JOIN images ON items.id = images.item_id
         GROUP BY items.id
-        """
-    ).fetchall()
-    return [{"id": row["id"], "name": row["name"], "brand": row["brand"], "size": row["size"], "color": row["color"], "fit": row["fit"], "category_id": row["category_id"], "category_name": row["category_name"], "filepaths": row["filepaths"].split(',') if row["filepaths"] else []} for row in rows]
+        """,
+        stream=stream,
+    )
+    return ({"id": row["id"], "name": row["name"], "brand": row["brand"], "size": row["size"], "color": row["color"], "fit": row["fit"], "category_id": row["category_id"], "category_name": row["category_name"], "filepaths": row["filepaths"].split(',') if row["filepaths"] else []} for row in rows)
 
 def items_all_for_user(user_id):
-    conn = connect_to_db()
-    # Create a cursor object
-    cursor = conn.cursor()
+    with connection() as conn:
+        # Create a cursor object
+        cursor = conn.cursor()
 
-    # Write the SQL query to select items for the given user_id
-    sql = "SELECT * FROM items WHERE user_id = ?"
+        # Write the SQL query to select items for the given user_id
+        sql = "SELECT * FROM items WHERE user_id = ?"
 
-    # Execute the query with the user_id parameter
-    cursor.execute(sql, (user_id,))
+        # Execute the query with the user_id parameter
+        cursor.execute(sql, (user_id,))
 
-    # Fetch all results and close the cursor
-    items = cursor.fetchall()
-    cursor.close()
+        # Fetch all results and close the cursor
+        items = cursor.fetchall()
+        cursor.close()
 
-    return items
+        return items
 
 
 
 
+@serialized_write
 def items_create(name, brand, size, color, fit, category_id, filename, filepath, user_id):
     # Log the incoming token for debugging purposes
 
-    conn = connect_to_db()
-
-    # Now use user_id and decoded_token separately without decoding again
-
-    try:
-        # Insert item data into the items table
-        cursor = conn.execute(
-            """
-            INSERT INTO items (name, brand, size, color, fit, category_id, user_id)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-            RETURNING id
-            """,
-            (name, brand, size, color, fit, category_id, user_id),
-        )
-        item_id = cursor.fetchone()[0]
+    with connection() as conn:
+        # Now use user_id and decoded_token separately without decoding again
 
-        # Insert image data into the images table
-        cursor = conn.execute(
-            """
-            INSERT INTO images (filename, filepath, item_id)
-            VALUES (?, ?, ?)
-            RETURNING *
-            """,
-            (filename, filepath, item_id),
-        )
-        inserted_image = cursor.fetchone()
+        try:
+            # Insert item data into the items table
+            cursor = conn.execute(
+                """
+                INSERT INTO items (name, brand, size, color, fit, category_id, user_id)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                RETURNING id
+                """,
+                (name, brand, size, color, fit, category_id, user_id),
+            )
+            item_id = cursor.fetchone()[0]
 
-        conn.commit()
-        return {"item_id": item_id, "image": dict(inserted_image)} if inserted_image else None
-    except Exception as e:
-        # Log the full stack trace for better debugging
-        logging.exception("Error creating item: %s", e)
+            # Insert image data into the images table
+            cursor = conn.execute(
+                """
+                INSERT INTO images (filename, filepath, item_id)
+                VALUES (?, ?, ?)
+                RETURNING *
+                """,
+                (filename, filepath, item_id),
+            )
+            inserted_image = cursor.fetchone()
+
+            conn.commit()
+            invalidate_item(item_id)
+            events.broker.publish(user_id)
+            return {"item_id": item_id, "image": dict(inserted_image)} if inserted_image else None
+        except Exception as e:
+            # Log the full stack trace for better debugging
+            logging.exception("Error creating item: %s", e)
         
-        # Return a more informative error message
-        return {"error": f"An error occurred while creating the item: {str(e)}"}
-    finally:
-        # Only close the connection if it's open
-        if conn:
-            conn.close()
+            # Return a more informative error message
+            return {"error": f"An error occurred while creating the item: {str(e)}"}
+
+@serialized_write
+def items_bulk_create(rows, user_id, chunk_size=1000):
+    """Insert many items (and their optional image) with executemany, one transaction per chunk.
+
+    ``rows`` are (name, brand, size, color, fit, category_id, filename, filepath)
+    tuples. Returns a list of (item_id, image_id or None) in input order.
+    """
+    created = []
+    with connection() as conn:
+        for start in range(0, len(rows), chunk_size):
+            chunk = rows[start:start + chunk_size]
+            # IMMEDIATE takes the write lock up front, so the ids handed out
+            # below cannot be taken by another writer before the insert.
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                last_id = conn.execute(
+                    """
+                    SELECT MAX(COALESCE((SELECT seq FROM sqlite_sequence WHERE name = 'items'), 0),
+                               COALESCE((SELECT MAX(id) FROM items), 0))
+                    """
+                ).fetchone()[0]
+                item_ids = list(range(last_id + 1, last_id + 1 + len(chunk)))
+                conn.executemany(
+                    """
+                    INSERT INTO items (id, name, brand, size, color, fit, category_id, user_id)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                    """,
+                    [(item_id,) + row[:6] + (user_id,) for item_id, row in zip(item_ids, chunk)],
+                )
+                with_images = [(row[6], row[7], item_id) for item_id, row in zip(item_ids, chunk) if row[7]]
+                conn.executemany(
+                    """
+                    INSERT INTO images (filename, filepath, item_id)
+                    VALUES (?, ?, ?)
+                    """,
+                    with_images,
+                )
+                image_ids = {
+                    r["item_id"]: r["id"]
+                    for r in conn.execute(
+                        "SELECT id, item_id FROM images WHERE item_id BETWEEN ? AND ?",
+                        (item_ids[0], item_ids[-1]),
+                    )
+                } if with_images else {}
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            created.extend((item_id, image_ids.get(item_id)) for item_id in item_ids)
+            events.broker.publish(user_id)
+    return created
 
 def items_find_by_id(id):
-    conn = connect_to_db()
-    row = conn.execute(
-        """
-        SELECT * FROM items
-        WHERE id = ?
-        """,
-        (id,),
-    ).fetchone()
-    return dict(row)
-
-def items_update_by_id(id, name, brand, size, color, fit, category_id, image,):
-    conn = connect_to_db()
-    try:
-        # Begin a transaction
-        conn.execute("BEGIN TRANSACTION;")
-        # Update item details in the items table
-        cursor = conn.execute(
+    with connection() as conn:
+        row = conn.execute(
             """
-            UPDATE items 
-            SET name = ?, brand = ?, size = ?, color = ?, fit = ?, category_id = ?
+            SELECT * FROM items
             WHERE id = ?
             """,
-            (name, brand, size, color, fit, category_id, id),
-        )
-
-        affected_rows = cursor.rowcount
-
-        # Now, retrieve the updated row
-        cursor.execute("SELECT * FROM items WHERE id = ?", (id,))
-        updated_row = cursor.fetchone()
-
-        # Print the updated row
+            (id,),
+        ).fetchone()
+        return dict(row)
 
-        # If a new image is provided, update or add it to the images table
-        if image:
-            filename = secure_filename(image.filename)
-            filepath = os.path.join('uploads', filename)
-            image.save(filepath)
-            conn.execute(
+@serialized_write
+def items_update_by_id(id, name, brand, size, color, fit, category_id, image,):
+    with connection() as conn:
+        try:
+            # IMMEDIATE waits (busy_timeout) for the write lock up front; a deferred
+            # BEGIN can fail at once with "database is locked" if another writer
+            # commits between this connection's read snapshot and its first write.
+            conn.execute("BEGIN IMMEDIATE TRANSACTION;")
+            # Update item details in the items table
+            cursor = conn.execute(
                 """
-                INSERT OR REPLACE INTO images (filename, filepath, item_id)
-                VALUES (?, ?, ?)
+                UPDATE items 
+                SET name = ?, brand = ?, size = ?, color = ?, fit = ?, category_id = ?
+                WHERE id = ?
                 """,
-                (filename, filepath, id),
+                (name, brand, size, color, fit, category_id, id),
             )
 
-        # Commit the transaction
-        conn.execute("COMMIT;")
+            affected_rows = cursor.rowcount
+
+            # Now, retrieve the updated row
+            cursor.execute("SELECT * FROM items WHERE id = ?", (id,))
+            updated_row = cursor.fetchone()
+
+            # Print the updated row
+
+            # If a new image is provided, update or add it to the images table
+            new_image = None
+            if image:
+                filename, filepath = store_upload(image)
+                cursor = conn.execute(
+                    """
+                    INSERT OR REPLACE INTO images (filename, filepath, item_id)
+                    VALUES (?, ?, ?)
+                    """,
+                    (filename, filepath, id),
+                )
+                new_image = {"id": cursor.lastrowid, "filename": filename, "filepath": filepath}
+
+            # Commit the transaction
+            conn.execute("COMMIT;")
+            invalidate_item(id)
+            if updated_row:
+                events.broker.publish(updated_row["user_id"])
         
-        # Fetch and return the updated item details
-        updated_row = conn.execute(
-            """
-            SELECT * FROM items
-            WHERE id = ?
-            """,
-            (id,),
-        ).fetchone()
+            # Fetch and return the updated item details
+            updated_row = conn.execute(
+                """
+                SELECT * FROM items
+                WHERE id = ?
+                """,
+                (id,),
+            ).fetchone()
         
-        return dict(updated_row)
-    except Exception as e:
-        # Rollback the transaction in case of any error
-        conn.execute("ROLLBACK;")
-        # Log the error for debugging purposes
-        logging.error(f"Error updating item: {e}")
-        # Return None to indicate failure
-        return None
-    finally:
-        # Close the database connection
-        conn.close()
-
+            return dict(updated_row, image=new_image)
+        except Exception as e:
+            # Rollback the transaction in case of any error
+            conn.execute("ROLLBACK;")
+            # Log the error for debugging purposes
+            logging.error(f"Error updating item: {e}")
+            # Return None to indicate failure
+            return None
+
+@serialized_write
 def items_destroy_by_id(id):
-    conn = connect_to_db()
-    conn.execute(
+    # Soft delete: the item row goes now and its images are detached and
+    # stamped deleted_at; sweeper.py reclaims those rows and their files later.
+    now = time.time()
+    with connection() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            item = conn.execute("DELETE FROM items WHERE id = ? RETURNING user_id", (id,)).fetchone()
+            if item:
+                images = conn.execute(
+                    """
+                    UPDATE images SET deleted_at = ?, item_id = NULL
+                    WHERE item_id = ? AND deleted_at IS NULL
+                    RETURNING id
+                    """,
+                    (now, id),
+                ).fetchall()
+                add_tombstones(conn, [("items", id, item["user_id"], id)] + [("images", image["id"], item["user_id"], id) for image in images], now)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    invalidate_item(id)
+    if item:
+        events.broker.publish(item["user_id"])
+    return {"message": "Item destroyed successfully"}
+
+def add_tombstones(conn, rows, deleted_at):
+    # rows are (table_name, row_id, user_id, item_id)
+    conn.executemany(
         """
-        DELETE from items
-        WHERE id = ?
+        INSERT INTO tombstones (table_name, row_id, user_id, item_id, deleted_at)
+        VALUES (?, ?, ?, ?, ?)
         """,
-        (id,)
+        [row + (deleted_at,) for row in rows],
     )
-    conn.commit()
-    return {"message": "Item destroyed successfully"}
 
-def get_item_with_category_and_images(item_id):
-    conn = connect_to_db()
-    cursor = conn.execute(
-        """
-        SELECT items.*, categories.category_name, GROUP_CONCAT(images.filename) AS filenames, GROUP_CONCAT(images.filepath) AS filepaths
+# Fields a client may ask for with ?fields=, mapped to the SQL that produces them
+ITEM_FIELDS = {
+    "id": "items.id",
+    "name": "items.name",
+    "brand": "items.brand",
+    "size": "items.size",
+    "color": "items.color",
+    "fit": "items.fit",
+    "category_id": "items.category_id",
+    "user_id": "items.user_id",
+    "category_name": "categories.category_name",
+    "filenames": "GROUP_CONCAT(images.filename) AS filenames",
+    "filepaths": "GROUP_CONCAT(images.filepath) AS filepaths",
+    # The first image's pre-rendered thumb variant, falling back to the original
+    "thumbnail": """(SELECT COALESCE(image_variants.filepath, images.filepath) FROM images
+                     LEFT JOIN image_variants ON image_variants.image_id = images.id AND image_variants.variant = 'thumb'
+                     WHERE images.item_id = items.id ORDER BY images.id LIMIT 1) AS thumbnail""",
+}
+ITEM_DEFAULT_FIELDS = [f for f in ITEM_FIELDS if f != "thumbnail"]
+
+
+def _projection(field_map, fields, default_fields=None):
+    # The id is always returned, since it is the pagination cursor
+    fields = list(fields or default_fields or field_map)
+    if "id" not in fields:
+        fields.insert(0, "id")
+    unknown = [f for f in fields if f not in field_map]
+    if unknown:
+        raise ValueError(f"Unknown field(s): {', '.join(unknown)}")
+    columns = [f for f in fields if f != "id"]
+    return fields, ", ".join([field_map["id"]] + [field_map[f] for f in columns])
+
+
+def _keyset(id_column, after_id, limit):
+    # WHERE/LIMIT fragments for keyset pagination ordered by id
+    where, params = "", []
+    if after_id is not None:
+        where = f" AND {id_column} > ?"
+        params.append(after_id)
+    tail = f" ORDER BY {id_column}"
+    if limit is not None:
+        tail += " LIMIT ?"
+        params.append(limit)
+    return where, tail, params
+
+
+def _trim(row, fields):
+    record = dict(row)
+    return {f: record[f] for f in fields}
+
+
+def items_all_with_category_and_images_for_user(user_id, limit=None, after_id=None, fields=None, filters=None):
+    return list(iter_items_with_category_and_images_for_user(user_id, limit, after_id, fields, filters, stream=False))
+
+def iter_items_with_category_and_images_for_user(user_id, limit=None, after_id=None, fields=None, filters=None, stream=True):
+    # One grouped query for the whole closet instead of a lookup per item
+    fields, columns = _projection(ITEM_FIELDS, fields, ITEM_DEFAULT_FIELDS)
+    where, tail, params = _keyset("items.id", after_id, limit)
+    facet_where, facet_params = _facet_where(filters)
+    where, params = facet_where + where, facet_params + params
+    # Skip the images join entirely when no image list was asked for
+    images_join = "LEFT JOIN images ON items.id = images.item_id" if {"filenames", "filepaths"} & set(fields) else ""
+    rows = iter_rows(
+        f"""
+        SELECT {columns}
         FROM items
         JOIN categories ON items.category_id = categories.id
-        LEFT JOIN images ON items.id = images.item_id
-        WHERE items.id = ?
+        {images_join}
+        WHERE items.user_id = ?{where}
         GROUP BY items.id
+        {tail}
         """,
-        (item_id,),
+        [user_id] + params,
+        stream=stream,
     )
-    row = cursor.fetchone()
-    conn.close()
-    if row:
-        item_with_images = dict(row)
-        item_with_images["filenames"] = item_with_images["filenames"].split(',') if item_with_images["filenames"] else []
-        item_with_images["filepaths"] = item_with_images["filepaths"].split(',') if item_with_images["filepaths"] else []
-        return item_with_images
-    else:
-        return None
+    return (_item_with_image_lists(row, fields) for row in rows)
+
+def _item_with_image_lists(row, fields):
+    item_with_images = _trim(row, fields)
+    for key in ("filenames", "filepaths"):
+        if key in item_with_images:
+            item_with_images[key] = item_with_images[key].split(',') if item_with_images[key] else []
+    return item_with_images
+
+# Facets a closet can be filtered and counted by. Category is filtered by name
+# but matched by id, so it stays on the (user_id, category_id, ...) index.
+FACET_COLUMNS = {
+    "category": "items.category_id",
+    "brand": "items.brand",
+    "color": "items.color",
+    "size": "items.size",
+}
+
+def _facet_where(filters):
+    # {"brand": ["HOPE"], "category": ["Shoes"]} -> " AND ..." fragment; values
+    # within a facet are OR'ed, facets are AND'ed
+    where, params = "", []
+    for facet, values in (filters or {}).items():
+        if not values:
+            continue
+        placeholders = ", ".join("?" * len(values))
+        if facet == "category":
+            where += f" AND items.category_id IN (SELECT id FROM categories WHERE category_name IN ({placeholders}))"
+        else:
+            where += f" AND {FACET_COLUMNS[facet]} IN ({placeholders})"
+        params.extend(values)
+    return where, params
+
+def items_facets(user_id, filters=None):
+    """Count a user's items per category, brand, color and size under ``filters``.
+
+    Each facet is counted with every filter except its own, so the counts say
+    how many items picking that value instead would return. ``total`` applies
+    all filters.
+    """
+    with connection() as conn:
+        category_names = dict(conn.execute("SELECT id, category_name FROM categories").fetchall())
+        # Answered from items_user_facets_idx alone, already in group order
+        combinations = conn.execute(
+            """
+            SELECT category_id, brand, color, size, COUNT(*)
+            FROM items
+            WHERE user_id = ?
+            GROUP BY category_id, brand, color, size
+            """,
+            (user_id,),
+        ).fetchall()
+    wanted = {facet: set(values) for facet, values in (filters or {}).items() if values}
+    if "category" in wanted:
+        wanted["category"] = {id for id, name in category_names.items() if name in wanted["category"]}
+    counts = {facet: {} for facet in FACET_COLUMNS}
+    total = 0
+    for *values, count in combinations:
+        values = dict(zip(FACET_COLUMNS, values))
+        misses = [facet for facet, allowed in wanted.items() if values[facet] not in allowed]
+        if not misses:
+            total += count
+        # A facet's own filter is ignored when counting that facet
+        for facet in FACET_COLUMNS:
+            if not misses or misses == [facet]:
+                counts[facet][values[facet]] = counts[facet].get(values[facet], 0) + count
+    facets = {}
+    for facet, by_value in counts.items():
+        if facet == "category":
+            entries = [{"value": category_names.get(id), "id": id, "count": n} for id, n in by_value.items()]
+        else:
+            entries = [{"value": value, "count": n} for value, n in by_value.items()]
+        facets[facet] = sorted(entries, key=lambda e: (-e["count"], str(e["value"])))
+    return {"total": total, "facets": facets}
+
+# bm25 column weights for items_fts: name, brand, color, fit, category_name, user_token
+SEARCH_WEIGHTS = "10.0, 5.0, 2.0, 1.0, 3.0, 0.0"
+
+def fts_query(text):
+    # Free text -> FTS5 query where every word must match as a prefix; quoting
+    # each word keeps FTS5 operators and punctuation in user input inert.
+    return " ".join(f'"{word}"*' for word in re.findall(r"\w+", text or ""))
+
+def items_search(user_id, text, limit=20, offset=0, fields=None):
+    """Rank a user's items against ``text`` with BM25 over name, brand, color, fit and category."""
+    match = fts_query(text)
+    if not match:
+        return []
+    fields, columns = _projection(ITEM_FIELDS, fields, ITEM_DEFAULT_FIELDS)
+    images_join = "LEFT JOIN images ON items.id = images.item_id" if {"filenames", "filepaths"} & set(fields) else ""
+    with connection() as conn:
+        rows = conn.execute(
+            f"""
+            WITH hits AS (
+                -- Joined and filtered before LIMIT, so a hit the outer joins
+                -- would drop (a category_id with no category) never takes a
+                -- place on the page
+                SELECT items.id, bm25(items_fts, {SEARCH_WEIGHTS}) AS rank
+                FROM items_fts
+                JOIN items ON items.id = items_fts.rowid
+                JOIN categories ON items.category_id = categories.id
+                WHERE items_fts MATCH ? AND items.user_id = ?
+                ORDER BY rank, items.id
+                LIMIT ? OFFSET ?
+            )
+            SELECT {columns}
+            FROM hits
+            JOIN items ON items.id = hits.id
+            JOIN categories ON items.category_id = categories.id
+            {images_join}
+            GROUP BY items.id
+            ORDER BY hits.rank, items.id
+            """,
+            (f'user_token : "u{int(user_id)}" AND {{name brand color fit category_name}} : ({match})', int(user_id), limit, offset),
+        ).fetchall()
+        return [_item_with_image_lists(row, fields) for row in rows]
+
+def get_item_with_category_and_images(item_id):
+    with connection() as conn:
+        cursor = conn.execute(
+            """
+            SELECT items.*, categories.category_name, GROUP_CONCAT(images.filename) AS filenames, GROUP_CONCAT(images.filepath) AS filepaths
+            FROM items
+            JOIN categories ON items.category_id = categories.id
+            LEFT JOIN images ON items.id = images.item_id
+            WHERE items.id = ?
+            GROUP BY items.id
+            """,
+            (item_id,),
+        )
+        row = cursor.fetchone()
+        if row:
+            item_with_images = dict(row)
+            item_with_images["filenames"] = item_with_images["filenames"].split(',') if item_with_images["filenames"] else []
+            item_with_images["filepaths"] = item_with_images["filepaths"].split(',') if item_with_images["filepaths"] else []
+            return item_with_images
+        else:
+            return None
 
 
 ############################### CATEGORIES #########################
 
 def categories_all():
-  conn = connect_to_db()
-  rows = conn.execute(
-      """
-      SELECT * FROM categories
-      """
-  ).fetchall()
-  return [dict(row) for row in rows]
+  with connection() as conn:
+    rows = conn.execute(
+        """
+        SELECT * FROM categories
+        """
+    ).fetchall()
+    return [dict(row) for row in rows]
 
 
+@serialized_write
 def categories_create(category_name):
-    conn = connect_to_db()
-    row = conn.execute(
-        """
-        INSERT INTO categories (category_name)
-        VALUES (?)
-        RETURNING *
-        """,
-        (category_name,),
-    ).fetchone()
-    conn.commit()
-    return dict(row)
+    with connection() as conn:
+        row = conn.execute(
+            """
+            INSERT INTO categories (category_name)
+            VALUES (?)
+            RETURNING *
+            """,
+            (category_name,),
+        ).fetchone()
+        conn.commit()
+        invalidate_categories()
+        events.broker.publish(None)
+        return dict(row)
 
 def categories_find_by_id(id):
-    conn = connect_to_db()
-    row = conn.execute(
-        """
-        SELECT * FROM categories
-        WHERE id = ?
-        """,
-        id,
-    ).fetchone()
-    return dict(row)
+    with connection() as conn:
+        row = conn.execute(
+            """
+            SELECT * FROM categories
+            WHERE id = ?
+            """,
+            (id,),
+        ).fetchone()
+        return dict(row)
 
+@serialized_write
 def categories_update_by_id(id, category_name):
-    conn = connect_to_db()
-    row = conn.execute(
-        """
-        UPDATE categories SET category_name = ? 
-        WHERE id = ?
-        RETURNING *
-        """,
-        (category_name, id),
-    ).fetchone()
-    conn.commit()
-    return dict(row)
+    with connection() as conn:
+        row = conn.execute(
+            """
+            UPDATE categories SET category_name = ? 
+            WHERE id = ?
+            RETURNING *
+            """,
+            (category_name, id),
+        ).fetchone()
+        conn.commit()
+        invalidate_categories()
+        events.broker.publish(None)
+        return dict(row)
 
+@serialized_write
 def categories_destroy_by_id(id):
-    conn = connect_to_db()
-    row = conn.execute(
-        """
-        DELETE from categories
-        WHERE id = ?
-        """,
-        (id,),
-    )
-    conn.commit()
-    return {"message": "Category destroyed successfully"}
+    with connection() as conn:
+        row = conn.execute(
+            """
+            DELETE from categories
+            WHERE id = ?
+            RETURNING id
+            """,
+            (id,),
+        ).fetchone()
+        if row:
+            # Categories are shared, so the tombstone belongs to no user
+            add_tombstones(conn, [("categories", id, None, None)], time.time())
+        conn.commit()
+        invalidate_categories()
+        events.broker.publish(None)
+        return {"message": "Category destroyed successfully"}
 
 
 ############################### USERS #########################
 
 
 def create_user(email, password):
-    conn = connect_to_db()
     hashed_password = hash_password(password)
-    row = conn.execute(
-        """
-        INSERT INTO users (email, password)
-        VALUES (?, ?)
-        RETURNING *
-        """,
-        (email, hashed_password),
-    ).fetchone()
-    conn.commit()
-    return dict(row)
+    with connection() as conn:
+        row = conn.execute(
+            """
+            INSERT INTO users (email, password)
+            VALUES (?, ?)
+            RETURNING *
+            """,
+            (email, hashed_password),
+        ).fetchone()
+        conn.commit()
+        return dict(row)
+
+# Password hashes are never listed
+USER_FIELDS = {"id": "id", "email": "email"}
+
+
+def get_all_users(limit=None, after_id=None, fields=None):
+    fields, columns = _projection(USER_FIELDS, fields)
+    where, tail, params = _keyset("id", after_id, limit)
+    with connection() as conn:
+        rows = conn.execute(
+            f"""
+            SELECT {columns} FROM users
+            WHERE 1 = 1{where}{tail}
+            """,
+            params,
+        ).fetchall()
+        return [_trim(row, fields) for row in rows]
 
 def get_user_by_email(email):
-    conn = connect_to_db()
-    row = conn.execute(
-        """
-        SELECT * FROM users
-        WHERE email = ?
-        """,
-        (email,),
-    ).fetchone()
-    return dict(row) if row else None
+    with connection() as conn:
+        row = conn.execute(
+            """
+            SELECT * FROM users
+            WHERE email = ?
+            """,
+            (email,),
+        ).fetchone()
+        return dict(row) if row else None
 
 def get_user_by_id(user_id):
-    conn = connect_to_db()
-    row = conn.execute(
-        """
-        SELECT * FROM users
-        WHERE id = ?
-        """,
-        (user_id,),
-    ).fetchone()
-    return dict(row) if row else None
+    with connection() as conn:
+        row = conn.execute(
+            """
+            SELECT * FROM users
+            WHERE id = ?
+            """,
+            (user_id,),
+        ).fetchone()
+        return dict(row) if row else None
 
 
+def update_user_password(user_id, hashed_password):
+    with connection() as conn:
+        conn.execute("UPDATE users SET password = ? WHERE id = ?", (hashed_password, user_id))
+        conn.commit()
+
+# Hashing runs on the bounded pool in passwords.py, not the request thread
 def hash_password(password):
-    return generate_password_hash(password, method="pbkdf2:sha256")
+    return passwords.hash_password(password)
 
 def check_password(password, hashed_password):
-    return check_password_hash(hashed_password, password)
+    return passwords.check_password(password, hashed_password)
 
 
 ############################### IMAGES #########################
 
-def images_all():
-  conn = connect_to_db()
-  rows = conn.execute(
-      """
-      SELECT * FROM images
-      """
-  ).fetchall()
-  return [dict(row) for row in rows]
+IMAGE_FIELDS = {"id": "id", "filename": "filename", "filepath": "filepath", "item_id": "item_id"}
+
+
+def images_all(limit=None, after_id=None, fields=None):
+  return list(iter_images(limit, after_id, fields, stream=False))
+
+def iter_images(limit=None, after_id=None, fields=None, stream=True):
+  fields, columns = _projection(IMAGE_FIELDS, fields)
+  where, tail, params = _keyset("id", after_id, limit)
+  rows = iter_rows(
+      f"""
+      SELECT {columns} FROM images
+      WHERE deleted_at IS NULL{where}{tail}
+      """,
+      params,
+      stream=stream,
+  )
+  return (_trim(row, fields) for row in rows)
+
+@serialized_write
+def image_variants_upsert(image_id, variant, filepath, width, height):
+    with connection() as conn:
+        conn.execute(
+            """
+            INSERT INTO image_variants (image_id, variant, filepath, width, height)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (image_id, variant) DO UPDATE
+            SET filepath = excluded.filepath, width = excluded.width, height = excluded.height
+            """,
+            (image_id, variant, filepath, width, height),
+        )
+        conn.commit()
+
+def image_variant_path(filepath, variant):
+    # Path of a pre-rendered variant of the image stored at filepath, if there is one
+    with connection() as conn:
+        row = conn.execute(
+            """
+            SELECT image_variants.filepath FROM image_variants
+            JOIN images ON image_variants.image_id = images.id
+            WHERE images.filepath = ? AND image_variants.variant = ?
+            """,
+            (filepath, variant),
+        ).fetchone()
+        return row["filepath"] if row else None
+
+def images_without_variants():
+    with connection() as conn:
+        return conn.execute(
+            """
+            SELECT id, filepath FROM images
+            WHERE filepath IS NOT NULL AND deleted_at IS NULL
+            AND NOT EXISTS (SELECT 1 FROM image_variants WHERE image_variants.image_id = images.id)
+            """
+        ).fetchall()
 
 # def images_create(filename, filepath, item_id):
 #     try:
@@ -501,18 +906,113 @@ def images_all():
 #     finally:
 #         conn.close()
 
+@serialized_write
 def images_destroy_by_id(id):
-    conn = connect_to_db()
-    row = conn.execute(
-        """
-        DELETE from images
-        WHERE id = ?
-        """,
-        (id,)
-    )
-    conn.commit()
+    # Soft delete, as for items: sweeper.py removes the row, variants and file later
+    now = time.time()
+    with connection() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                """
+                SELECT images.item_id, items.user_id FROM images
+                LEFT JOIN items ON items.id = images.item_id
+                WHERE images.id = ? AND images.deleted_at IS NULL
+                """,
+                (id,),
+            ).fetchone()
+            if row:
+                conn.execute("UPDATE images SET deleted_at = ?, item_id = NULL WHERE id = ?", (now, id))
+                add_tombstones(conn, [("images", id, row["user_id"], row["item_id"])], now)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    if row:
+        invalidate_item(row["item_id"])
+        if row["user_id"] is not None:
+            events.broker.publish(row["user_id"])
     return {"message": "Item destroyed successfully"}
 
+############################### SYNC #########################
+
+SYNC_ITEM_COLUMNS = "items.id, items.name, items.brand, items.size, items.color, items.fit, items.category_id, items.version"
+SYNC_IMAGE_COLUMNS = "images.id, images.item_id, images.filename, images.filepath, images.version"
+
+def sync_version():
+    with connection() as conn:
+        return conn.execute("SELECT version FROM sync_clock").fetchone()[0]
+
+def sync_changes(user_id, since=0, limit=None):
+    """What changed in ``user_id``'s closet after version ``since``, oldest change first.
+
+    Returns {"version", "full", "more", "items", "images", "categories", "deleted"}:
+    upserted items and categories, every live image of each upserted item, and
+    deleted ids per table. Pass ``version`` back as ``since`` next time; ``more``
+    means ``limit`` cut the changes short. ``full`` means ``since`` is older than
+    the oldest tombstone kept, so everything was returned and the client should
+    replace its copy rather than merge.
+    """
+    with connection() as conn:
+        # One read transaction, so the clock and every list come from the same snapshot
+        conn.execute("BEGIN")
+        try:
+            clock = conn.execute("SELECT version, tombstones_purged_through FROM sync_clock").fetchone()
+            full = since < clock["tombstones_purged_through"]
+            if full:
+                since = 0
+            # One extra change per table tells us whether there is more
+            fetch = limit + 1 if limit else -1
+            items = conn.execute(
+                f"SELECT {SYNC_ITEM_COLUMNS} FROM items WHERE user_id = ? AND version > ? ORDER BY version LIMIT ?",
+                (user_id, since, fetch),
+            ).fetchall()
+            categories = conn.execute(
+                "SELECT id, category_name, version FROM categories WHERE version > ? ORDER BY version LIMIT ?",
+                (since, fetch),
+            ).fetchall()
+            tombstones = conn.execute(
+                """
+                SELECT table_name, row_id, version FROM tombstones
+                WHERE (user_id = ? OR user_id IS NULL) AND version > ?
+                ORDER BY version LIMIT ?
+                """,
+                (user_id, since, fetch),
+            ).fetchall()
+            version = clock["version"]
+            changes = sorted(row["version"] for row in items + categories + tombstones)
+            more = bool(limit) and len(changes) > limit
+            if more:
+                # Stop just before the first change left out. One write can give
+                # an image and two items the same version; those are never split.
+                version = changes[limit] - 1 if changes[limit] - 1 > since else changes[limit]
+            items = [row for row in items if row["version"] <= version]
+            images = conn.execute(
+                f"""
+                SELECT {SYNC_IMAGE_COLUMNS} FROM items
+                JOIN images ON images.item_id = items.id
+                WHERE items.user_id = ? AND items.version > ? AND items.version <= ? AND images.deleted_at IS NULL
+                """,
+                (user_id, since, version),
+            ).fetchall() if items else []
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    deleted = {"items": [], "images": [], "categories": []}
+    for row in tombstones:
+        if row["version"] <= version:
+            deleted[row["table_name"]].append(row["row_id"])
+    return {
+        "version": version,
+        "full": full,
+        "more": more,
+        "items": [dict(row) for row in items],
+        "images": [dict(row) for row in images],
+        "categories": [dict(row) for row in categories if row["version"] <= version],
+        "deleted": deleted,
+    }
+
 # def update_table():
 #     conn = connect_to_db()
 #     try:
@@ -0,0 +1,86 @@
+# db_stress.py
+# Runs mixed readers and writers against a throwaway database and reports any
+# "database is locked" (or other) errors. Usage:
+#   python db_stress.py [--readers 8] [--writers 4] [--seconds 10] [--write-queue]
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--readers", type=int, default=8)
+parser.add_argument("--writers", type=int, default=4)
+parser.add_argument("--seconds", type=float, default=10)
+parser.add_argument("--write-queue", action="store_true")
+args = parser.parse_args()
+
+tmpdir = tempfile.mkdtemp()
+os.environ["DATABASE"] = os.path.join(tmpdir, "stress.db")
+os.environ["DB_POOL_SIZE"] = str(args.readers + args.writers)
+os.environ["DB_WRITE_QUEUE"] = "true" if args.write_queue else "false"
+
+import db  # noqa: E402  (reads DATABASE and friends at import time)
+
+db.initial_setup()
+with db.connection() as conn:
+    conn.execute("INSERT INTO users (email, password) VALUES ('stress@example.com', 'x')")
+    conn.execute("INSERT INTO categories (category_name) VALUES ('Shirts')")
+    conn.commit()
+
+deadline = time.monotonic() + args.seconds
+counts = {"reads": 0, "writes": 0}
+errors = []
+lock = threading.Lock()
+
+
+def record(kind, error=None):
+    with lock:
+        if error:
+            errors.append(f"{kind}: {error}")
+        else:
+            counts[kind] += 1
+
+
+def reader():
+    while time.monotonic() < deadline:
+        try:
+            db.items_all_with_category_and_images_for_user(1)
+            record("reads")
+        except sqlite3.Error as e:
+            record("reads", e)
+
+
+def writer():
+    while time.monotonic() < deadline:
+        result = db.items_create("Tee", "Brand", "M", "White", "regular", 1, "tee.png", "uploads/tee.png", 1)
+        if not result or "error" in result:
+            record("writes", result)
+            continue
+        item_id = result["item_id"]
+        if db.items_update_by_id(item_id, "Tee", "Brand", "L", "Black", "boxy", 1, None) is None:
+            record("writes", f"update of item {item_id} failed")
+            continue
+        try:
+            db.images_destroy_by_id(result["image"]["id"])
+            db.items_destroy_by_id(item_id)
+        except sqlite3.Error as e:
+            record("writes", e)
+            continue
+        record("writes")
+
+
+threads = [threading.Thread(target=reader) for _ in range(args.readers)]
+threads += [threading.Thread(target=writer) for _ in range(args.writers)]
+for t in threads:
+    t.start()
+for t in threads:
+    t.join()
+
+print(f"reads: {counts['reads']}  write cycles: {counts['writes']}  errors: {len(errors)}")
+print("pool:", db.pool.get_stats())
+for error in errors[:10]:
+    print(" ", error)
+sys.exit(1 if errors else 0)
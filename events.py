@@ -0,0 +1,203 @@
+# events.py
+# Server-sent events of closet changes. The write functions in db.py call
+# broker.publish() once they commit, which only wakes that user's open
+# streams; each woken stream then sends the /sync delta since the last event
+# it sent, with the change version as the SSE id. A reconnect with
+# Last-Event-ID therefore resumes exactly where the stream stopped, from the
+# database rather than from a buffer. Writes made by other processes reach
+# this one through ChangeRelay, which watches the shared sync_clock.
+import json
+import logging
+import threading
+import time
+from decouple import config
+
+# Seconds of silence before a stream sends a keep-alive comment
+HEARTBEAT_INTERVAL = config("EVENTS_HEARTBEAT_INTERVAL", default=15, cast=float)
+# How often ChangeRelay checks for writes by other processes; 0 disables it
+POLL_INTERVAL = config("EVENTS_POLL_INTERVAL", default=1.0, cast=float)
+# Reconnect delay suggested to EventSource clients, in milliseconds
+RETRY_MS = config("EVENTS_RETRY_MS", default=3000, cast=int)
+# Changes per event; larger deltas go out as several events
+BATCH_SIZE = 500
+
+
+class Broker:
+    """In-process fan-out: ``publish(user_id)`` calls every wake callback subscribed for that user.
+
+    ``publish(None)`` wakes every subscriber, for changes to shared data such
+    as categories. Callbacks run on the publishing thread, so they must only
+    flag their stream to go and look, never do the work themselves.
+    """
+
+    def __init__(self):
+        self._subscribers = {}  # str(user_id) -> set of wake callbacks
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(user_id):
+        # Tokens carry the id as a string, while db.py publishes the integer
+        # from items.user_id; both must land on the same subscribers
+        return str(user_id)
+
+    def subscribe(self, user_id, wake):
+        with self._lock:
+            self._subscribers.setdefault(self._key(user_id), set()).add(wake)
+
+    def unsubscribe(self, user_id, wake):
+        key = self._key(user_id)
+        with self._lock:
+            wakes = self._subscribers.get(key)
+            if wakes is not None:
+                wakes.discard(wake)
+                if not wakes:
+                    del self._subscribers[key]
+
+    def user_ids(self):
+        with self._lock:
+            return list(self._subscribers)
+
+    def subscriber_count(self):
+        with self._lock:
+            return sum(len(wakes) for wakes in self._subscribers.values())
+
+    def publish(self, user_id):
+        with self._lock:
+            if user_id is None:
+                wakes = [wake for user_wakes in self._subscribers.values() for wake in user_wakes]
+            else:
+                wakes = list(self._subscribers.get(self._key(user_id), ()))
+        for wake in wakes:
+            try:
+                wake()
+            except Exception:
+                logging.exception("Could not wake an event stream")
+
+
+broker = Broker()
+
+
+class ChangeRelay:
+    """Publishes to ``broker`` the changes other processes commit to the shared database.
+
+    Every ``interval`` seconds, while anyone is subscribed, it reads the
+    one-row sync_clock; only when that has moved does it look up which
+    subscribed users' rows changed. Changes this process made itself are
+    woken twice, which costs a stream one empty delta.
+    """
+
+    def __init__(self, broker, connection, interval=1.0):
+        self.broker = broker
+        self._connection = connection
+        self.interval = interval
+        self._seen = None
+        self._thread = None
+
+    def start(self):
+        if self._thread is None and self.interval > 0:
+            self._thread = threading.Thread(target=self._run, name="change-relay", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.poll()
+            except Exception:
+                logging.exception("Change relay poll failed")
+
+    def poll(self):
+        user_ids = self.broker.user_ids()
+        if not user_ids:
+            self._seen = None
+            return
+        with self._connection() as conn:
+            version = conn.execute("SELECT version FROM sync_clock").fetchone()[0]
+            since, self._seen = self._seen, version
+            if since is None or version <= since:
+                return
+            shared = conn.execute(
+                """
+                SELECT EXISTS (SELECT 1 FROM categories WHERE version > ?)
+                    OR EXISTS (SELECT 1 FROM tombstones WHERE user_id IS NULL AND version > ?)
+                """,
+                (since, since),
+            ).fetchone()[0]
+            if shared:
+                self.broker.publish(None)
+                return
+            changed = set()
+            for start in range(0, len(user_ids), 500):
+                chunk = user_ids[start:start + 500]
+                placeholders = ", ".join("?" * len(chunk))
+                for table in ("items", "tombstones"):
+                    changed.update(
+                        row[0] for row in conn.execute(
+                            f"SELECT DISTINCT user_id FROM {table} WHERE user_id IN ({placeholders}) AND version > ?",
+                            chunk + [since],
+                        )
+                    )
+        for user_id in changed:
+            self.broker.publish(user_id)
+
+
+def format_event(event, data, id=None):
+    frame = f"id: {id}\n" if id is not None else ""
+    return f"{frame}event: {event}\ndata: {json.dumps(data, separators=(',', ':'))}\n\n"
+
+
+def opening(version):
+    # Sets the client's Last-Event-ID right away, so even a stream that is
+    # dropped before any change resumes from here
+    return f"retry: {RETRY_MS}\n" + format_event("ready", {"version": version}, id=version)
+
+
+HEARTBEAT = ": heartbeat\n\n"
+
+
+def drain(load_changes, since):
+    """Return (SSE frames for every change after ``since``, version to continue from).
+
+    ``load_changes(since)`` returns a db.sync_changes() delta.
+    """
+    frames = []
+    while True:
+        delta = load_changes(since)
+        if delta["full"] or delta["items"] or delta["categories"] or any(delta["deleted"].values()):
+            frames.append(format_event("change", delta, id=delta["version"]))
+        since = delta["version"]
+        if not delta["more"]:
+            return frames, since
+
+
+class EventStream:
+    """One subscriber's SSE frames. ``since`` is the client's Last-Event-ID, or None to start from now.
+
+    Iterating blocks a thread between changes. asgi.py finds the instance in
+    the WSGI environ under ENVIRON_KEY and runs the same steps on the event
+    loop instead, where an idle subscriber costs no thread.
+    """
+
+    ENVIRON_KEY = "closet.event_stream"
+
+    def __init__(self, user_id, since, load_changes, current_version):
+        self.user_id = user_id
+        self.since = since
+        self.load_changes = load_changes
+        self.current_version = current_version
+
+    def __iter__(self):
+        woken = threading.Event()
+        broker.subscribe(self.user_id, woken.set)
+        try:
+            # Subscribed before reading, so a commit in between still wakes us
+            since = self.current_version() if self.since is None else self.since
+            yield opening(since)
+            while True:
+                frames, since = drain(self.load_changes, since)
+                yield from frames
+                while not woken.wait(HEARTBEAT_INTERVAL):
+                    yield HEARTBEAT
+                woken.clear()
+        finally:
+            broker.unsubscribe(self.user_id, woken.set)
@@ -0,0 +1,80 @@
+# image_variants.py
+# Pre-renders resized WebP copies of uploaded images on a background pool so
+# the closet grid can fetch small tiles instead of multi-MB originals.
+# Usage: python image_variants.py   (renders variants for images that have none)
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from decouple import config
+import db
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow is optional; without it originals are served as-is
+    Image = None
+
+VARIANTS_FOLDER = os.path.join('uploads', 'variants')
+
+
+def _parse_widths(value):
+    # "thumb:200,medium:600" -> {"thumb": 200, "medium": 600}
+    widths = {}
+    for part in value.split(","):
+        name, _, width = part.partition(":")
+        widths[name.strip()] = int(width)
+    return widths
+
+
+# Fixed-width variants; "webp" (full size, re-encoded) is always added
+VARIANT_WIDTHS = _parse_widths(config("IMAGE_VARIANT_WIDTHS", default="thumb:200,medium:600"))
+VARIANT_NAMES = set(VARIANT_WIDTHS) | {"webp"}
+WEBP_QUALITY = config("IMAGE_WEBP_QUALITY", default=80, cast=int)
+
+_executor = ThreadPoolExecutor(max_workers=config("IMAGE_WORKERS", default=2, cast=int), thread_name_prefix="image-variants")
+
+
+def schedule(image_id, filepath):
+    """Render the variants for an images row in the background. Returns the future, or None."""
+    if Image is None or not filepath:
+        return None
+    return _executor.submit(_render_logged, image_id, filepath)
+
+
+def _render_logged(image_id, filepath):
+    try:
+        return render(image_id, filepath)
+    except Exception:
+        logging.exception("Could not render variants for image %s (%s)", image_id, filepath)
+        return []
+
+
+def render(image_id, filepath):
+    os.makedirs(VARIANTS_FOLDER, exist_ok=True)
+    stem = os.path.splitext(os.path.basename(filepath))[0]
+    created = []
+    with Image.open(filepath) as original:
+        original.load()
+        source = original if original.mode in ("RGB", "RGBA") else original.convert("RGBA")
+        targets = dict(VARIANT_WIDTHS, webp=source.width)
+        for variant, width in targets.items():
+            if width > source.width:
+                width = source.width  # never upscale
+            height = max(1, round(source.height * width / source.width))
+            resized = source if width == source.width else source.resize((width, height), Image.LANCZOS)
+            variant_path = os.path.join(VARIANTS_FOLDER, f"{image_id}_{stem}_{variant}.webp")
+            resized.save(variant_path, "WEBP", quality=WEBP_QUALITY)
+            db.image_variants_upsert(image_id, variant, variant_path, width, height)
+            created.append(variant_path)
+    return created
+
+
+def backfill():
+    futures = [schedule(row["id"], row["filepath"]) for row in db.images_without_variants() if os.path.isfile(row["filepath"] or "")]
+    return sum(len(f.result()) for f in futures if f)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    if Image is None:
+        raise SystemExit("Pillow is not installed")
+    print("Variants rendered:", backfill())
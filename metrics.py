@@ -0,0 +1,235 @@
+# metrics.py
+# In-process metrics rendered in the Prometheus text format on /metrics:
+# per-route latency histograms, per-query timings and row counts (recorded by
+# the connection class db.py opens), plus gauges read at scrape time from the
+# connection pool and caches.
+import sqlite3
+import sys
+import threading
+import time
+from decouple import config
+from flask import Response, abort, g, request
+
+# Seconds; shared by the route and query histograms
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Optional bearer token required to scrape /metrics
+METRICS_TOKEN = config("METRICS_TOKEN", default="")
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+class Counter:
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_labels(self.labelnames, key)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._series = {}  # label values -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+                    break
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, series in sorted(self._series.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets, series):
+                    cumulative += count
+                    lines.append(f"{self.name}_bucket{_labels(self.labelnames, key, [('le', bound)])} {cumulative}")
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, key, [('le', '+Inf')])} {series[-1]}")
+                lines.append(f"{self.name}_sum{_labels(self.labelnames, key)} {series[-2]}")
+                lines.append(f"{self.name}_count{_labels(self.labelnames, key)} {series[-1]}")
+        return lines
+
+
+_metrics = []
+# Functions returning [(name, type, help, [(labels dict, value), ...])], called on every scrape
+_collectors = []
+
+
+def register(metric):
+    _metrics.append(metric)
+    return metric
+
+
+def register_collector(collect):
+    _collectors.append(collect)
+    return collect
+
+
+def render():
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+    for collect in _collectors:
+        for name, kind, help, samples in collect():
+            lines += [f"# HELP {name} {help}", f"# TYPE {name} {kind}"]
+            for labels, value in samples:
+                lines.append(f"{name}{_labels(labels.keys(), labels.values())} {value}")
+    return "\n".join(lines) + "\n"
+
+
+request_duration = register(Histogram(
+    "http_request_duration_seconds", "Time spent in the view, by route.", ["method", "route", "status"],
+))
+query_duration = register(Histogram(
+    "db_query_duration_seconds", "Time to execute a query and step to its first row, by calling function.", ["query"],
+))
+query_fetch_seconds = register(Counter(
+    "db_query_fetch_seconds_total", "Time spent fetching rows after execute, by calling function.", ["query"],
+))
+query_rows = register(Counter(
+    "db_query_rows_total", "Rows fetched by SELECTs or changed by writes, by calling function.", ["query"],
+))
+
+
+############################# DATABASE #########################
+
+# Frames skipped when naming a query after the code that ran it
+_PLUMBING_MODULES = {__name__, "contextlib", "pool"}
+_PLUMBING_FUNCTIONS = {"iter_rows", "_pooled_rows", "<genexpr>", "_item_with_image_lists"}
+
+
+def _query_name():
+    frame = sys._getframe(2)
+    while frame is not None:
+        module = frame.f_globals.get("__name__")
+        if module not in _PLUMBING_MODULES and frame.f_code.co_name not in _PLUMBING_FUNCTIONS:
+            return f"{module}.{frame.f_code.co_name}"
+        frame = frame.f_back
+    return "unknown"
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """Cursor that times each query and counts the rows it returns or changes."""
+
+    _query = "unknown"
+
+    def execute(self, sql, parameters=()):
+        self._query = _query_name()
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            query_duration.observe(time.perf_counter() - start, query=self._query)
+            if self.rowcount > 0:
+                query_rows.inc(self.rowcount, query=self._query)
+
+    def executemany(self, sql, seq_of_parameters):
+        self._query = _query_name()
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            query_duration.observe(time.perf_counter() - start, query=self._query)
+            if self.rowcount > 0:
+                query_rows.inc(self.rowcount, query=self._query)
+
+    def _fetched(self, start, rows):
+        query_fetch_seconds.inc(time.perf_counter() - start, query=self._query)
+        if rows:
+            query_rows.inc(rows, query=self._query)
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = super().fetchone()
+        self._fetched(start, int(row is not None))
+        return row
+
+    def fetchmany(self, size=None):
+        start = time.perf_counter()
+        rows = super().fetchmany(size if size is not None else self.arraysize)
+        self._fetched(start, len(rows))
+        return rows
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = super().fetchall()
+        self._fetched(start, len(rows))
+        return rows
+
+    def __next__(self):
+        # Counted without timing: iterating row by row would make timing dominate
+        row = super().__next__()
+        query_rows.inc(query=self._query)
+        return row
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    """sqlite3.connect(..., factory=InstrumentedConnection) records every query in the metrics above."""
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    # The C implementations of these bypass cursor(), so route them through it
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+############################# FLASK #########################
+
+def init_app(app):
+    """Time every request and serve the registered metrics on /metrics."""
+
+    @app.before_request
+    def start_timer():
+        g.request_started = time.perf_counter()
+
+    @app.after_request
+    def record_duration(response):
+        started = g.pop("request_started", None)
+        if started is not None:
+            route = request.url_rule.rule if request.url_rule else "unmatched"
+            request_duration.observe(time.perf_counter() - started, method=request.method, route=route, status=response.status_code)
+        return response
+
+    @app.route("/metrics")
+    def metrics_index():
+        if METRICS_TOKEN and request.headers.get("Authorization") != f"Bearer {METRICS_TOKEN}":
+            abort(401)
+        return Response(render(), mimetype="text/plain; version=0.0.4")
@@ -0,0 +1,380 @@
+# migrations.py
+# Versioned schema migrations. The applied version is kept in SQLite's
+# PRAGMA user_version, so each migration runs exactly once per database.
+# Usage: python migrations.py   (migrates database.db and checks query plans)
+import logging
+import sqlite3
+import sys
+
+
+def _run(conn, script):
+    # Not executescript(): that commits first, breaking the per-migration transaction.
+    # complete_statement() keeps trigger bodies (which contain ";") in one piece.
+    statement = ""
+    for line in script.splitlines(keepends=True):
+        statement += line
+        if sqlite3.complete_statement(statement):
+            conn.execute(statement)
+            statement = ""
+
+
+def _baseline(conn):
+    _run(
+        conn,
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            email TEXT UNIQUE NOT NULL,
+            password TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS categories (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            category_name TEXT UNIQUE NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS items (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT,
+            brand TEXT,
+            size TEXT,
+            color TEXT,
+            fit TEXT,
+            category_id INT,
+            user_id INT,
+            FOREIGN KEY (category_id) REFERENCES categories (id),
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        );
+        CREATE TABLE IF NOT EXISTS images (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            filename TEXT,
+            filepath TEXT,
+            item_id INT,
+            FOREIGN KEY (item_id) REFERENCES items (id)
+        );
+        """
+    )
+
+
+def _fix_images_foreign_key(conn):
+    # Older databases still point images.item_id at the long-gone items_old table
+    sql = conn.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'images'").fetchone()[0]
+    if "items_old" not in sql:
+        return
+    _run(
+        conn,
+        """
+        CREATE TABLE images_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            filename TEXT,
+            filepath TEXT,
+            item_id INT,
+            FOREIGN KEY (item_id) REFERENCES items (id)
+        );
+        INSERT INTO images_new (id, filename, filepath, item_id)
+        SELECT id, filename, filepath, item_id FROM images;
+        DROP TABLE images;
+        ALTER TABLE images_new RENAME TO images;
+        """
+    )
+
+
+def _add_indexes(conn):
+    _run(
+        conn,
+        """
+        CREATE INDEX IF NOT EXISTS items_user_id_idx ON items (user_id, id);
+        CREATE INDEX IF NOT EXISTS items_category_id_idx ON items (category_id);
+        CREATE INDEX IF NOT EXISTS images_item_id_idx ON images (item_id, filename, filepath);
+        """
+    )
+
+
+def _add_revoked_tokens(conn):
+    _run(
+        conn,
+        """
+        CREATE TABLE IF NOT EXISTS revoked_tokens (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            token_hash TEXT UNIQUE NOT NULL,
+            expires_at INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS revoked_tokens_expires_at_idx ON revoked_tokens (expires_at);
+        """
+    )
+
+
+def _add_image_variants(conn):
+    _run(
+        conn,
+        """
+        CREATE TABLE IF NOT EXISTS image_variants (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            image_id INT NOT NULL,
+            variant TEXT NOT NULL,
+            filepath TEXT NOT NULL,
+            width INT,
+            height INT,
+            UNIQUE (image_id, variant),
+            FOREIGN KEY (image_id) REFERENCES images (id)
+        );
+        CREATE INDEX IF NOT EXISTS images_filepath_idx ON images (filepath);
+        """
+    )
+
+
+def _add_items_fts(conn):
+    # user_token ("u<user_id>") is indexed so per-user scoping is part of the
+    # MATCH itself rather than a filter over every hit.
+    _run(
+        conn,
+        """
+        CREATE VIRTUAL TABLE IF NOT EXISTS items_fts USING fts5(
+            name, brand, color, fit, category_name, user_token,
+            tokenize = 'unicode61 remove_diacritics 2',
+            prefix = '2 3 4'
+        );
+        INSERT INTO items_fts (rowid, name, brand, color, fit, category_name, user_token)
+        SELECT items.id, items.name, items.brand, items.color, items.fit, categories.category_name, 'u' || items.user_id
+        FROM items LEFT JOIN categories ON items.category_id = categories.id;
+        CREATE TRIGGER IF NOT EXISTS items_fts_insert AFTER INSERT ON items BEGIN
+            INSERT INTO items_fts (rowid, name, brand, color, fit, category_name, user_token)
+            VALUES (new.id, new.name, new.brand, new.color, new.fit,
+                    (SELECT category_name FROM categories WHERE id = new.category_id), 'u' || new.user_id);
+        END;
+        CREATE TRIGGER IF NOT EXISTS items_fts_update AFTER UPDATE ON items BEGIN
+            DELETE FROM items_fts WHERE rowid = old.id;
+            INSERT INTO items_fts (rowid, name, brand, color, fit, category_name, user_token)
+            VALUES (new.id, new.name, new.brand, new.color, new.fit,
+                    (SELECT category_name FROM categories WHERE id = new.category_id), 'u' || new.user_id);
+        END;
+        CREATE TRIGGER IF NOT EXISTS items_fts_delete AFTER DELETE ON items BEGIN
+            DELETE FROM items_fts WHERE rowid = old.id;
+        END;
+        CREATE TRIGGER IF NOT EXISTS items_fts_category_update AFTER UPDATE OF category_name ON categories BEGIN
+            UPDATE items_fts SET category_name = new.category_name
+            WHERE rowid IN (SELECT id FROM items WHERE category_id = new.id);
+        END;
+        CREATE TRIGGER IF NOT EXISTS items_fts_category_delete AFTER DELETE ON categories BEGIN
+            UPDATE items_fts SET category_name = NULL
+            WHERE rowid IN (SELECT id FROM items WHERE category_id = old.id);
+        END;
+        """
+    )
+
+
+def _add_facet_indexes(conn):
+    # Covers every facet column, so the grouped facet counts read only the
+    # user's slice of this index, already in group order, without touching rows.
+    _run(conn, "CREATE INDEX IF NOT EXISTS items_user_facets_idx ON items (user_id, category_id, brand, color, size);")
+
+
+def _add_tombstones(conn):
+    # Deleted items and images leave a tombstone row; their images rows are
+    # detached (item_id NULL) and stamped with deleted_at, and sweeper.py
+    # reclaims them and their files later in small batches.
+    _run(
+        conn,
+        """
+        ALTER TABLE images ADD COLUMN deleted_at REAL;
+        CREATE INDEX IF NOT EXISTS images_deleted_at_idx ON images (deleted_at) WHERE deleted_at IS NOT NULL;
+        CREATE INDEX IF NOT EXISTS image_variants_filepath_idx ON image_variants (filepath);
+        CREATE TABLE IF NOT EXISTS tombstones (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            table_name TEXT NOT NULL,
+            row_id INT NOT NULL,
+            user_id INT,
+            item_id INT,
+            deleted_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS tombstones_deleted_at_idx ON tombstones (deleted_at);
+        UPDATE images SET deleted_at = unixepoch(), item_id = NULL
+        WHERE NOT EXISTS (SELECT 1 FROM items WHERE items.id = images.item_id);
+        """
+    )
+
+
+
+def _add_sync_versions(conn):
+    # One clock for the whole database: every insert or update of an item,
+    # image or category, and every tombstone, takes the next value, so a
+    # client that has seen version N asks only for rows with version > N.
+    # An image change also bumps its item, so a user's changed images are
+    # found through their changed items. Existing rows start at version 1.
+    _run(
+        conn,
+        """
+        CREATE TABLE IF NOT EXISTS sync_clock (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            version INT NOT NULL,
+            tombstones_purged_through INT NOT NULL DEFAULT 0
+        );
+        INSERT OR IGNORE INTO sync_clock (id, version) VALUES (1, 1);
+        ALTER TABLE items ADD COLUMN version INT NOT NULL DEFAULT 1;
+        ALTER TABLE images ADD COLUMN version INT NOT NULL DEFAULT 1;
+        ALTER TABLE categories ADD COLUMN version INT NOT NULL DEFAULT 1;
+        ALTER TABLE tombstones ADD COLUMN version INT NOT NULL DEFAULT 1;
+        CREATE INDEX IF NOT EXISTS items_user_version_idx ON items (user_id, version);
+        CREATE INDEX IF NOT EXISTS categories_version_idx ON categories (version);
+        CREATE INDEX IF NOT EXISTS tombstones_user_version_idx ON tombstones (user_id, version);
+        CREATE TRIGGER IF NOT EXISTS items_version_insert AFTER INSERT ON items BEGIN
+            UPDATE sync_clock SET version = version + 1;
+            UPDATE items SET version = (SELECT version FROM sync_clock) WHERE id = new.id;
+        END;
+        CREATE TRIGGER IF NOT EXISTS items_version_update AFTER UPDATE OF name, brand, size, color, fit, category_id, user_id ON items BEGIN
+            UPDATE sync_clock SET version = version + 1;
+            UPDATE items SET version = (SELECT version FROM sync_clock) WHERE id = new.id;
+        END;
+        CREATE TRIGGER IF NOT EXISTS images_version_insert AFTER INSERT ON images BEGIN
+            UPDATE sync_clock SET version = version + 1;
+            UPDATE images SET version = (SELECT version FROM sync_clock) WHERE id = new.id;
+            UPDATE items SET version = (SELECT version FROM sync_clock) WHERE id = new.item_id;
+        END;
+        CREATE TRIGGER IF NOT EXISTS images_version_update AFTER UPDATE OF filename, filepath, item_id, deleted_at ON images BEGIN
+            UPDATE sync_clock SET version = version + 1;
+            UPDATE images SET version = (SELECT version FROM sync_clock) WHERE id = new.id;
+            UPDATE items SET version = (SELECT version FROM sync_clock) WHERE id IN (new.item_id, old.item_id);
+        END;
+        CREATE TRIGGER IF NOT EXISTS categories_version_insert AFTER INSERT ON categories BEGIN
+            UPDATE sync_clock SET version = version + 1;
+            UPDATE categories SET version = (SELECT version FROM sync_clock) WHERE id = new.id;
+        END;
+        CREATE TRIGGER IF NOT EXISTS categories_version_update AFTER UPDATE OF category_name ON categories BEGIN
+            UPDATE sync_clock SET version = version + 1;
+            UPDATE categories SET version = (SELECT version FROM sync_clock) WHERE id = new.id;
+        END;
+        CREATE TRIGGER IF NOT EXISTS tombstones_version_insert AFTER INSERT ON tombstones BEGIN
+            UPDATE sync_clock SET version = version + 1;
+            UPDATE tombstones SET version = (SELECT version FROM sync_clock) WHERE id = new.id;
+        END;
+        -- Setting items.version must not rewrite the item's full-text row
+        DROP TRIGGER IF EXISTS items_fts_update;
+        CREATE TRIGGER items_fts_update AFTER UPDATE OF name, brand, color, fit, category_id, user_id ON items BEGIN
+            DELETE FROM items_fts WHERE rowid = old.id;
+            INSERT INTO items_fts (rowid, name, brand, color, fit, category_name, user_token)
+            VALUES (new.id, new.name, new.brand, new.color, new.fit,
+                    (SELECT category_name FROM categories WHERE id = new.category_id), 'u' || new.user_id);
+        END;
+        """
+    )
+
+
+# (version, description, function). Append new migrations; never reorder or edit applied ones.
+MIGRATIONS = [
+    (1, "baseline schema", _baseline),
+    (2, "point images.item_id at items", _fix_images_foreign_key),
+    (3, "indexes for per-user listing and image joins", _add_indexes),
+    (4, "persistent token revocation list", _add_revoked_tokens),
+    (5, "resized image variants", _add_image_variants),
+    (6, "full-text search over items", _add_items_fts),
+    (7, "covering index for per-user facets", _add_facet_indexes),
+    (8, "soft-delete tombstones for items and images", _add_tombstones),
+    (9, "change versions for delta sync", _add_sync_versions),
+]
+
+
+def current_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(conn):
+    version = current_version(conn)
+    for target, description, apply in MIGRATIONS:
+        if target <= version:
+            continue
+        logging.info("Applying migration %s: %s", target, description)
+        conn.execute("BEGIN")
+        try:
+            apply(conn)
+            conn.execute(f"PRAGMA user_version = {target}")
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        version = target
+    return version
+
+
+# Queries on the request path that must be answered from an index
+HOT_QUERIES = {
+    "items for user": (
+        """
+        SELECT items.*, categories.category_name, GROUP_CONCAT(images.filename), GROUP_CONCAT(images.filepath)
+        FROM items
+        JOIN categories ON items.category_id = categories.id
+        LEFT JOIN images ON items.id = images.item_id
+        WHERE items.user_id = ?
+        GROUP BY items.id
+        ORDER BY items.id
+        """,
+        (1,),
+    ),
+    "item with images": (
+        """
+        SELECT items.*, categories.category_name, GROUP_CONCAT(images.filename), GROUP_CONCAT(images.filepath)
+        FROM items
+        JOIN categories ON items.category_id = categories.id
+        LEFT JOIN images ON items.id = images.item_id
+        WHERE items.id = ?
+        GROUP BY items.id
+        """,
+        (1,),
+    ),
+    "item facets": (
+        "SELECT category_id, brand, color, size, COUNT(*) FROM items WHERE user_id = ? GROUP BY category_id, brand, color, size",
+        (1,),
+    ),
+    "items by category and brand": (
+        "SELECT id FROM items WHERE user_id = ? AND category_id IN (?) AND brand IN (?) ORDER BY id",
+        (1, 1, "HOPE"),
+    ),
+    "items in category": ("SELECT id FROM items WHERE category_id = ?", (1,)),
+    "images for item": ("SELECT filename, filepath FROM images WHERE item_id = ?", (1,)),
+    "expired image rows": ("SELECT id, filepath FROM images WHERE deleted_at < ? LIMIT 100", (0,)),
+    "variant by file": ("SELECT 1 FROM image_variants WHERE filepath = ?", ("uploads/variants/a.webp",)),
+    "items changed since": ("SELECT * FROM items WHERE user_id = ? AND version > ? ORDER BY version LIMIT 100", (1, 0)),
+    "categories changed since": ("SELECT * FROM categories WHERE version > ? ORDER BY version LIMIT 100", (0,)),
+    "tombstones since": (
+        "SELECT table_name, row_id, version FROM tombstones WHERE (user_id = ? OR user_id IS NULL) AND version > ? ORDER BY version LIMIT 100",
+        (1, 0),
+    ),
+    "user by email": ("SELECT * FROM users WHERE email = ?", ("someone@example.com",)),
+    "image variant": (
+        """
+        SELECT image_variants.filepath FROM image_variants
+        JOIN images ON image_variants.image_id = images.id
+        WHERE images.filepath = ? AND image_variants.variant = ?
+        """,
+        ("uploads/a.png", "thumb"),
+    ),
+    "revoked token": ("SELECT 1 FROM revoked_tokens WHERE token_hash = ? AND expires_at > ?", ("0" * 64, 0)),
+}
+
+
+def full_scans(conn, queries=None):
+    """Return {query name: [plan lines]} for every query that scans a whole table."""
+    tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    failures = {}
+    for name, (sql, params) in (queries or HOT_QUERIES).items():
+        plan = [row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params)]
+        scans = [line for line in plan if line.startswith("SCAN ") and line.split()[1] in tables]
+        if scans:
+            failures[name] = scans
+    return failures
+
+
+def check_query_plans(conn, queries=None):
+    failures = full_scans(conn, queries)
+    if failures:
+        details = "; ".join(f"{name}: {', '.join(lines)}" for name, lines in failures.items())
+        raise RuntimeError(f"Hot queries fall back to a full table scan: {details}")
+
+
+if __name__ == "__main__":
+    import db
+
+    logging.basicConfig(level=logging.INFO)
+    with db.connection() as conn:
+        print("Schema version:", migrate(conn))
+        failures = full_scans(conn)
+    for name, lines in failures.items():
+        print(f"FULL SCAN in {name!r}: {', '.join(lines)}")
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,135 @@
+# passwords.py
+# Password hashing runs on a small dedicated pool so a burst of logins or
+# signups cannot tie up every request thread, and a per-email/per-IP failure
+# throttle refuses credential-stuffing bursts before any hashing is done.
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from decouple import config
+from werkzeug.security import DEFAULT_PBKDF2_ITERATIONS, check_password_hash, generate_password_hash
+
+# Work factor for new hashes; stored hashes with fewer iterations are upgraded on login
+HASH_ITERATIONS = config("PASSWORD_HASH_ITERATIONS", default=DEFAULT_PBKDF2_ITERATIONS, cast=int)
+HASH_METHOD = f"pbkdf2:sha256:{HASH_ITERATIONS}"
+# hashlib's pbkdf2 releases the GIL, so threads hash in parallel
+HASH_WORKERS = config("PASSWORD_HASH_WORKERS", default=2, cast=int)
+# Hashes allowed to wait for a worker before callers are turned away
+HASH_QUEUE_SIZE = config("PASSWORD_HASH_QUEUE_SIZE", default=32, cast=int)
+
+_executor = ThreadPoolExecutor(max_workers=HASH_WORKERS, thread_name_prefix="password-hash")
+_slots = threading.BoundedSemaphore(HASH_WORKERS + HASH_QUEUE_SIZE)
+
+# Verified against when the email is unknown, so response time does not reveal which emails exist
+_DUMMY_HASH = generate_password_hash("not a password", method=HASH_METHOD)
+
+
+class HashingBusy(Exception):
+    """Raised when the hashing pool's queue is full."""
+
+
+def _submit(func, *args):
+    if not _slots.acquire(blocking=False):
+        raise HashingBusy("Too many password checks in progress, try again shortly")
+    try:
+        future = _executor.submit(func, *args)
+    except BaseException:
+        _slots.release()
+        raise
+    future.add_done_callback(lambda _: _slots.release())
+    return future
+
+
+def hash_password(password):
+    return _submit(generate_password_hash, password, HASH_METHOD).result()
+
+
+def check_password(password, hashed_password):
+    matched = _submit(check_password_hash, hashed_password or _DUMMY_HASH, password or "").result()
+    return matched and hashed_password is not None
+
+
+# PBKDF2 digests at least as strong as the sha256 of HASH_METHOD
+_STRONG_DIGESTS = {"sha256", "sha384", "sha512", "sha3_256", "sha3_384", "sha3_512"}
+
+
+def needs_rehash(hashed_password):
+    """True only if the stored hash is weaker than HASH_METHOD.
+
+    A weaker digest or fewer iterations is upgraded; more iterations or
+    another algorithm (scrypt) is left alone, so lowering the setting never
+    downgrades a hash.
+    """
+    method, _, _ = hashed_password.partition("$")
+    name, _, args = method.partition(":")
+    if name != "pbkdf2":
+        return False
+    digest, _, iterations = args.partition(":")
+    if digest not in _STRONG_DIGESTS:
+        return True
+    # Hashes from old werkzeug versions may omit the count; theirs was lower
+    return not iterations.isdigit() or int(iterations) < HASH_ITERATIONS
+
+
+def rehash_later(password, on_hashed):
+    """Hash ``password`` at the current work factor in the background and pass the result to ``on_hashed``."""
+    def done(future):
+        try:
+            on_hashed(future.result())
+        except Exception:
+            logging.exception("Could not upgrade a password hash")
+
+    try:
+        _submit(generate_password_hash, password, HASH_METHOD).add_done_callback(done)
+    except HashingBusy:
+        pass  # upgraded on a later login instead
+
+
+class LoginThrottle:
+    """Counts failed logins per key in a sliding window.
+
+    Keys are things like "email:<address>" and "ip:<address>". ``retry_after``
+    says how long a key must wait once it has reached its limit.
+    """
+
+    def __init__(self, window=300, maxkeys=100000):
+        self.window = window
+        self.maxkeys = maxkeys
+        self._failures = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _recent(self, key, now):
+        failures = [t for t in self._failures.get(key, ()) if t > now - self.window]
+        if failures:
+            self._failures[key] = failures
+        else:
+            self._failures.pop(key, None)
+        return failures
+
+    def retry_after(self, key, limit):
+        """Seconds until ``key`` may try again, or 0 if it is under ``limit``."""
+        now = time.monotonic()
+        with self._lock:
+            failures = self._recent(key, now)
+            if len(failures) < limit:
+                return 0
+            return failures[-limit] + self.window - now
+
+    def failed(self, key):
+        now = time.monotonic()
+        with self._lock:
+            self._failures.setdefault(key, []).append(now)
+            self._failures.move_to_end(key)
+            while len(self._failures) > self.maxkeys:
+                self._failures.popitem(last=False)
+
+    def reset(self, key):
+        with self._lock:
+            self._failures.pop(key, None)
+
+
+login_throttle = LoginThrottle(window=config("LOGIN_THROTTLE_WINDOW", default=300, cast=float))
+# Failed attempts allowed per window for one email, and from one client address
+LOGIN_MAX_FAILURES_PER_EMAIL = config("LOGIN_MAX_FAILURES_PER_EMAIL", default=5, cast=int)
+LOGIN_MAX_FAILURES_PER_IP = config("LOGIN_MAX_FAILURES_PER_IP", default=20, cast=int)
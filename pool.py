@@ -0,0 +1,113 @@
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class ConnectionPool:
+    """A fixed-size pool of sqlite3 connections shared between threads.
+
+    Connections are opened lazily up to ``size`` and handed out one thread at a
+    time. Use ``connection()`` so a connection always goes back to the pool,
+    even when the caller raises.
+    """
+
+    def __init__(self, connect, size=5, timeout=30.0, leak_timeout=60.0):
+        self._connect = connect
+        self.size = size
+        self.timeout = timeout
+        self.leak_timeout = leak_timeout
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._checked_out = {}
+        self._created = 0
+        self.stats = {"created": 0, "checkouts": 0, "waits": 0, "leaks": 0}
+
+    def acquire(self):
+        conn = self._get()
+        with self._lock:
+            self.stats["checkouts"] += 1
+            self._checked_out[id(conn)] = [time.monotonic(), False]
+        return conn
+
+    def _get(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            can_create = self._created < self.size
+            if can_create:
+                self._created += 1
+                self.stats["created"] += 1
+        if can_create:
+            try:
+                return self._connect()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+
+        # Every connection is checked out, so wait for one to come back
+        with self._lock:
+            self.stats["waits"] += 1
+        self._check_leaks()
+        try:
+            return self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise PoolTimeout(f"No database connection available after {self.timeout}s")
+
+    def release(self, conn):
+        with self._lock:
+            self._checked_out.pop(id(conn), None)
+        try:
+            # Never hand the next caller a half-finished transaction
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            logging.exception("Discarding broken database connection")
+            with self._lock:
+                self._created -= 1
+            conn.close()
+            return
+        self._idle.put(conn)
+
+    def _check_leaks(self):
+        # A checkout held past leak_timeout is counted (once) as a leak
+        now = time.monotonic()
+        with self._lock:
+            for entry in self._checked_out.values():
+                if not entry[1] and now - entry[0] > self.leak_timeout:
+                    entry[1] = True
+                    self.stats["leaks"] += 1
+                    logging.warning("Database connection checked out for more than %ss", self.leak_timeout)
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def get_stats(self):
+        self._check_leaks()
+        with self._lock:
+            return dict(self.stats, size=self.size, open=self._created, in_use=len(self._checked_out))
+
+    def close(self):
+        with self._lock:
+            while True:
+                try:
+                    conn = self._idle.get_nowait()
+                except queue.Empty:
+                    break
+                conn.close()
+                self._created -= 1
@@ -0,0 +1,98 @@
+# profiler.py
+# Opt-in sampling profiler for slow requests. While PROFILE_SLOW_REQUESTS is
+# on, one background thread samples the stack of every thread serving a
+# request; requests slower than PROFILE_SLOW_REQUEST_THRESHOLD have their
+# samples written to PROFILE_DIR as folded stacks ("a;b;c count" lines), ready
+# for flamegraph.pl or speedscope.
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from decouple import config
+from flask import g, request
+
+PROFILE_SLOW_REQUESTS = config("PROFILE_SLOW_REQUESTS", default=False, cast=bool)
+SAMPLE_INTERVAL = config("PROFILE_SAMPLE_INTERVAL", default=0.005, cast=float)
+SLOW_REQUEST_THRESHOLD = config("PROFILE_SLOW_REQUEST_THRESHOLD", default=0.5, cast=float)
+PROFILE_DIR = config("PROFILE_DIR", default="profiles")
+
+
+def fold(frame):
+    # Outermost frame first, as flamegraph tools expect
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class Sampler:
+    """Samples the stacks of registered threads every ``interval`` seconds."""
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self._active = {}  # thread id -> Counter of folded stacks
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self, thread_id):
+        with self._lock:
+            self._active[thread_id] = Counter()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+                self._thread.start()
+
+    def stop(self, thread_id):
+        with self._lock:
+            return self._active.pop(thread_id, Counter())
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                if not self._active:
+                    continue
+                frames = sys._current_frames()
+                for thread_id, stacks in self._active.items():
+                    frame = frames.get(thread_id)
+                    if frame is not None:
+                        stacks[fold(frame)] += 1
+
+
+sampler = Sampler(SAMPLE_INTERVAL)
+
+
+def write_folded(stacks, name):
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    path = os.path.join(PROFILE_DIR, name + ".folded")
+    with open(path, "w") as out:
+        for stack, count in stacks.most_common():
+            out.write(f"{stack} {count}\n")
+    return path
+
+
+def init_app(app):
+    """Profile every request when PROFILE_SLOW_REQUESTS is on; a no-op otherwise."""
+    if not PROFILE_SLOW_REQUESTS:
+        return
+
+    @app.before_request
+    def start_sampling():
+        g.profile_started = time.perf_counter()
+        sampler.start(threading.get_ident())
+
+    # teardown runs even when the view raised, so no thread stays registered
+    @app.teardown_request
+    def stop_sampling(exc=None):
+        stacks = sampler.stop(threading.get_ident())
+        started = g.pop("profile_started", None)
+        if started is None or not stacks:
+            return
+        elapsed = time.perf_counter() - started
+        if elapsed >= SLOW_REQUEST_THRESHOLD:
+            name = f"{time.strftime('%Y%m%dT%H%M%S')}-{request.endpoint or 'unmatched'}-{int(elapsed * 1000)}ms"
+            path = write_folded(stacks, name)
+            logging.warning("Slow request %s %s took %.0f ms; stacks in %s", request.method, request.path, elapsed * 1000, path)
@@ -0,0 +1,200 @@
+# ratelimit.py
+# Admission control in front of every route. Each request spends a token from
+# its user's bucket (user_id from the JWT) and from its client address's
+# bucket, for the route group it belongs to (auth, writes, reads, images);
+# an empty bucket answers 429 with Retry-After. A global cap on requests in
+# their view at once sheds the excess with 503 before any work is done.
+# Buckets live in memory, or in a small SQLite file (RATE_LIMIT_STORE) that
+# every worker process on the host shares.
+import math
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from decouple import config
+from flask import g, jsonify, request
+import auth
+import metrics
+
+# "<requests>/<seconds>" per group: a bucket holds <requests> tokens and
+# refills at that rate; empty or "0" turns the group's limit off
+GROUP_LIMITS = {
+    "auth": config("RATE_LIMIT_AUTH", default="20/60"),
+    "writes": config("RATE_LIMIT_WRITES", default="120/60"),
+    "reads": config("RATE_LIMIT_READS", default="600/60"),
+    "images": config("RATE_LIMIT_IMAGES", default="1200/60"),
+}
+# Several users can share one address (NAT, offices), so its buckets are larger
+IP_FACTOR = config("RATE_LIMIT_IP_FACTOR", default=4, cast=float)
+# Requests allowed in their view at once across the process; 0 disables the cap
+MAX_CONCURRENT_REQUESTS = config("MAX_CONCURRENT_REQUESTS", default=64, cast=int)
+# Path of a SQLite file to share buckets between workers; empty keeps them in memory
+RATE_LIMIT_STORE = config("RATE_LIMIT_STORE", default="")
+
+AUTH_ENDPOINTS = {"login", "signup", "logout"}
+IMAGE_ENDPOINTS = {"serve_image"}
+EXEMPT_ENDPOINTS = {"metrics_index"}
+
+rejected = metrics.register(metrics.Counter(
+    "http_requests_rejected_total", "Requests refused by admission control, by route group and reason.", ["group", "reason"],
+))
+
+
+def parse_limit(spec):
+    # "120/60" -> (capacity 120, refill 2.0 tokens a second); None when off
+    if not spec or spec == "0":
+        return None
+    requests, _, seconds = spec.partition("/")
+    capacity = float(requests)
+    return capacity, capacity / float(seconds or 1)
+
+
+LIMITS = {group: parse_limit(spec) for group, spec in GROUP_LIMITS.items()}
+
+
+def _refill(tokens, updated, now, capacity, rate):
+    """Spend one token from a bucket last seen at ``updated``.
+
+    Returns (tokens left, seconds to wait); a wait of 0 means the token was spent.
+    """
+    tokens = min(capacity, tokens + max(0.0, now - updated) * rate)
+    if tokens >= 1:
+        return tokens - 1, 0.0
+    return tokens, (1 - tokens) / rate
+
+
+class TokenBuckets:
+    """Token buckets for one process, bounded to ``maxkeys`` least recently used keys.
+
+    A bucket dropped for space comes back full, which only errs on the side of
+    admitting a request.
+    """
+
+    def __init__(self, maxkeys=100000):
+        self.maxkeys = maxkeys
+        self._buckets = OrderedDict()  # key -> (tokens, updated)
+        self._lock = threading.Lock()
+
+    def take(self, key, capacity, rate):
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (capacity, now))
+            tokens, wait = _refill(tokens, updated, now, capacity, rate)
+            self._buckets[key] = (tokens, now)
+            self._buckets.move_to_end(key)
+            while len(self._buckets) > self.maxkeys:
+                self._buckets.popitem(last=False)
+        return wait
+
+
+class SQLiteTokenBuckets:
+    """Token buckets in a SQLite file shared by every worker process on the host.
+
+    The file holds nothing worth keeping, so it is written without fsync, and
+    it is separate from the main database so admission never waits on its
+    writer. Rows idle for ``idle_after`` seconds are full again and get pruned.
+    """
+
+    def __init__(self, path, idle_after=3600, prune_every=1000):
+        self.path = path
+        self.idle_after = idle_after
+        self.prune_every = prune_every
+        self._local = threading.local()
+        self._takes = 0
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.execute("PRAGMA synchronous = OFF")
+            conn.execute("CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)")
+            self._local.conn = conn
+        return conn
+
+    def take(self, key, capacity, rate):
+        conn = self._connection()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT tokens, updated FROM buckets WHERE key = ?", (key,)).fetchone()
+            tokens, wait = _refill(*(row or (capacity, now)), now, capacity, rate)
+            conn.execute("INSERT OR REPLACE INTO buckets (key, tokens, updated) VALUES (?, ?, ?)", (key, tokens, now))
+            self._takes += 1
+            if self._takes % self.prune_every == 0:
+                conn.execute("DELETE FROM buckets WHERE updated < ?", (now - self.idle_after,))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return wait
+
+
+buckets = SQLiteTokenBuckets(RATE_LIMIT_STORE) if RATE_LIMIT_STORE else TokenBuckets()
+_in_flight = threading.BoundedSemaphore(MAX_CONCURRENT_REQUESTS) if MAX_CONCURRENT_REQUESTS > 0 else None
+
+
+def route_group():
+    if request.endpoint in AUTH_ENDPOINTS:
+        return "auth"
+    if request.endpoint in IMAGE_ENDPOINTS:
+        return "images"
+    if request.method in ("GET", "HEAD"):
+        return "reads"
+    return "writes"
+
+
+def _user_id():
+    # The view still authenticates; an invalid token here is just "no user"
+    header = request.headers.get("Authorization", "")
+    if not header.startswith("Bearer "):
+        return None
+    try:
+        return auth.verify_token(header[7:])
+    except Exception:
+        return None
+
+
+def _refuse(status, group, reason, retry_after, message):
+    rejected.inc(group=group, reason=reason)
+    response = jsonify({"error": message})
+    response.status_code = status
+    response.headers["Retry-After"] = str(max(1, math.ceil(retry_after)))
+    return response
+
+
+def init_app(app):
+    """Apply the group rate limits and the concurrency cap to every request."""
+
+    @app.before_request
+    def admit():
+        if request.method == "OPTIONS" or request.endpoint in EXEMPT_ENDPOINTS:
+            return None
+        group = route_group()
+        limit = LIMITS.get(group)
+        if limit:
+            capacity, rate = limit
+            keys = [(f"ip:{request.remote_addr}:{group}", capacity * IP_FACTOR, rate * IP_FACTOR)]
+            user_id = _user_id()
+            if user_id is not None:
+                keys.insert(0, (f"user:{user_id}:{group}", capacity, rate))
+            # A user over their limit stops here without also draining the
+            # bucket of the address they share with others
+            for key, key_capacity, key_rate in keys:
+                wait = buckets.take(key, key_capacity, key_rate)
+                if wait:
+                    return _refuse(429, group, "rate", wait, "Too many requests, slow down")
+        # Overload is the server's problem rather than the client's, so it is
+        # a 503, like a full password-hashing queue
+        if _in_flight is not None:
+            if not _in_flight.acquire(blocking=False):
+                return _refuse(503, group, "concurrency", 1, "Server is busy, try again shortly")
+            g.admitted = True
+        return None
+
+    # teardown runs even when the view raised, so no slot is ever lost; a
+    # streamed body is sent after this, so open streams hold no slot
+    @app.teardown_request
+    def release(exc=None):
+        if g.pop("admitted", False):
+            _in_flight.release()
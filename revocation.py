@@ -0,0 +1,117 @@
+import hashlib
+import logging
+import threading
+import time
+
+
+def token_hash(token):
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+class BloomFilter:
+    """Fixed-size bloom filter over SHA-256 hex digests (no false negatives)."""
+
+    def __init__(self, bits=1 << 20, hashes=7):
+        self.bits = bits
+        self.hashes = hashes
+        self._array = bytearray(bits // 8)
+
+    def _positions(self, digest):
+        # Slice the 256-bit digest into `hashes` independent 32-bit indexes
+        for i in range(self.hashes):
+            yield int(digest[i * 8:(i + 1) * 8], 16) % self.bits
+
+    def add(self, digest):
+        for pos in self._positions(digest):
+            self._array[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, digest):
+        return all(self._array[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(digest))
+
+
+class RevocationStore:
+    """Revoked tokens, persisted in the revoked_tokens table and shared by every worker.
+
+    Lookups go to a local bloom filter first, so a token that was never revoked
+    costs no database access. The filter picks up revocations made by other
+    processes at most ``refresh_interval`` seconds late. Every ``purge_interval``
+    seconds, rows whose token ``exp`` has passed are deleted, since such a
+    token fails verification anyway.
+    """
+
+    def __init__(self, connection, refresh_interval=5.0, purge_interval=300.0, bloom_bits=1 << 20):
+        self._connection = connection
+        self.refresh_interval = refresh_interval
+        self.purge_interval = purge_interval
+        self._purged_at = time.monotonic()
+        self._bloom_bits = bloom_bits
+        self._bloom = BloomFilter(bloom_bits)
+        self._last_id = 0
+        self._refreshed_at = 0.0
+        self._lock = threading.Lock()
+
+    def revoke(self, token, expires_at):
+        digest = token_hash(token)
+        with self._connection() as conn:
+            conn.execute(
+                """
+                INSERT OR IGNORE INTO revoked_tokens (token_hash, expires_at)
+                VALUES (?, ?)
+                """,
+                (digest, int(expires_at)),
+            )
+            conn.commit()
+        with self._lock:
+            self._bloom.add(digest)
+
+    def is_revoked(self, token):
+        self._maybe_refresh()
+        digest = token_hash(token)
+        if digest not in self._bloom:
+            return False
+        # Possible false positive: confirm against the table
+        with self._connection() as conn:
+            row = conn.execute(
+                """
+                SELECT 1 FROM revoked_tokens
+                WHERE token_hash = ? AND expires_at > ?
+                """,
+                (digest, int(time.time())),
+            ).fetchone()
+        return row is not None
+
+    def _maybe_refresh(self):
+        if time.monotonic() - self._refreshed_at < self.refresh_interval:
+            return
+        with self._lock:
+            if time.monotonic() - self._refreshed_at < self.refresh_interval:
+                return
+            try:
+                self._refresh()
+            except Exception:
+                # Keep serving from the current filter; the next request retries
+                logging.exception("Could not refresh the token revocation list")
+            self._refreshed_at = time.monotonic()
+
+    def _refresh(self):
+        with self._connection() as conn:
+            purged = 0
+            if time.monotonic() - self._purged_at >= self.purge_interval:
+                purged = conn.execute(
+                    "DELETE FROM revoked_tokens WHERE expires_at <= ?", (int(time.time()),)
+                ).rowcount
+                conn.commit()
+                self._purged_at = time.monotonic()
+            bloom, last_id = self._bloom, self._last_id
+            if purged:
+                # Bloom filters cannot forget, so rebuild from what is left. The
+                # new filter is only swapped in once full: is_revoked reads
+                # self._bloom without the lock and must never see it part-built.
+                bloom, last_id = BloomFilter(self._bloom_bits), 0
+            rows = conn.execute(
+                "SELECT id, token_hash FROM revoked_tokens WHERE id > ? ORDER BY id", (last_id,)
+            ).fetchall()
+        for row in rows:
+            bloom.add(row["token_hash"])
+            last_id = row["id"]
+        self._bloom, self._last_id = bloom, last_id
@@ -0,0 +1,267 @@
+# sweeper.py
+# Incremental garbage collection for deleted closet data. Deleting an item or
+# image only leaves a tombstone (see db.items_destroy_by_id); this module
+# later reclaims, in small time-boxed batches:
+#   - images rows deleted more than GC_GRACE_PERIOD ago, their variants, and
+#     any blob no remaining row references
+#   - blob, variant and spool files nothing references (crashed uploads etc.)
+#   - tombstones older than TOMBSTONE_RETENTION (clients syncing from before
+#     them get a full /sync instead)
+# Each batch is its own short write transaction and files are removed after
+# it commits, so the database write lock is never held for long.
+# Usage: python sweeper.py [--dry-run] [--budget SECONDS]
+import json
+import logging
+import os
+import threading
+import time
+from decouple import config
+import blobstore
+import db
+import image_variants
+
+GC_INTERVAL = config("GC_INTERVAL", default=300, cast=float)  # seconds between background sweeps; 0 disables them
+GC_TIME_BUDGET = config("GC_TIME_BUDGET", default=0.5, cast=float)  # seconds of work per background sweep
+GC_BATCH_SIZE = config("GC_BATCH_SIZE", default=100, cast=int)  # rows per write transaction
+GC_GRACE_PERIOD = config("GC_GRACE_PERIOD", default=3600, cast=float)  # deleted rows and unreferenced files younger than this are kept
+TOMBSTONE_RETENTION = config("TOMBSTONE_RETENTION", default=30 * 86400, cast=float)
+
+UPLOADS_FOLDER = "uploads"
+
+
+def _new_report(dry_run):
+    return {
+        "dry_run": dry_run,
+        "image_rows": 0,
+        "variant_rows": 0,
+        "tombstones": 0,
+        "blob_files": 0,
+        "variant_files": 0,
+        "spool_files": 0,
+        "bytes": 0,
+        # Files directly in uploads/ that nothing references. They may be
+        # hand-placed assets, so they are reported but never removed.
+        "unreferenced_legacy_files": [],
+        "complete": False,
+    }
+
+
+def _purge_image_rows(report, deadline, dry_run, batch_size):
+    cutoff = time.time() - GC_GRACE_PERIOD
+    with db.connection() as conn:
+        if dry_run:
+            report["image_rows"] = conn.execute("SELECT COUNT(*) FROM images WHERE deleted_at < ?", (cutoff,)).fetchone()[0]
+            variants = conn.execute(
+                "SELECT filepath FROM image_variants WHERE image_id IN (SELECT id FROM images WHERE deleted_at < ?)", (cutoff,)
+            ).fetchall()
+            report["variant_rows"] = report["variant_files"] = len(variants)
+            report["bytes"] += sum(_size(row["filepath"]) for row in variants)
+            # Blobs whose only references are rows about to be purged
+            for row in conn.execute(
+                """
+                SELECT DISTINCT filepath FROM images
+                WHERE deleted_at < ? AND filepath IS NOT NULL
+                AND NOT EXISTS (
+                    SELECT 1 FROM images AS other
+                    WHERE other.filepath = images.filepath AND (other.deleted_at IS NULL OR other.deleted_at >= ?)
+                )
+                """,
+                (cutoff, cutoff),
+            ):
+                if blobstore.is_blob(row["filepath"]) and _older_than(row["filepath"], cutoff):
+                    report["blob_files"] += 1
+                    report["bytes"] += _size(row["filepath"])
+            return True
+        while time.monotonic() < deadline:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                ids = [row["id"] for row in conn.execute("SELECT id FROM images WHERE deleted_at < ? LIMIT ?", (cutoff, batch_size))]
+                placeholders = ", ".join("?" * len(ids))
+                variants = conn.execute(
+                    f"DELETE FROM image_variants WHERE image_id IN ({placeholders}) RETURNING filepath", ids
+                ).fetchall()
+                images = conn.execute(f"DELETE FROM images WHERE id IN ({placeholders}) RETURNING filepath", ids).fetchall()
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            report["image_rows"] += len(images)
+            report["variant_rows"] += len(variants)
+            # Files go only after the commit, outside the write transaction. A
+            # blob written within the grace period may belong to an upload of
+            # the same bytes whose row is not in yet; _sweep_files gets it later.
+            for filepath in {row["filepath"] for row in images if row["filepath"]}:
+                if not _older_than(filepath, cutoff):
+                    continue
+                size = _size(filepath)
+                references = conn.execute("SELECT COUNT(*) FROM images WHERE filepath = ?", (filepath,)).fetchone()[0]
+                if blobstore.release(filepath, references):
+                    report["blob_files"] += 1
+                    report["bytes"] += size
+            for row in variants:
+                report["bytes"] += _remove(row["filepath"])
+                report["variant_files"] += 1
+            if len(ids) < batch_size:
+                return True
+    return False
+
+
+def _purge_tombstones(report, deadline, dry_run, batch_size):
+    cutoff = time.time() - TOMBSTONE_RETENTION
+    with db.connection() as conn:
+        if dry_run:
+            report["tombstones"] = conn.execute("SELECT COUNT(*) FROM tombstones WHERE deleted_at < ?", (cutoff,)).fetchone()[0]
+            return True
+        while time.monotonic() < deadline:
+            versions = [
+                row["version"]
+                for row in conn.execute(
+                    "DELETE FROM tombstones WHERE id IN (SELECT id FROM tombstones WHERE deleted_at < ? LIMIT ?) RETURNING version",
+                    (cutoff, batch_size),
+                )
+            ]
+            if versions:
+                # /sync clients older than this have missed deletions and must start over
+                conn.execute(
+                    "UPDATE sync_clock SET tombstones_purged_through = MAX(tombstones_purged_through, ?)", (max(versions),)
+                )
+            conn.commit()
+            report["tombstones"] += len(versions)
+            if len(versions) < batch_size:
+                return True
+    return False
+
+
+def _candidate_files():
+    # Every file the sweeper may look at, one directory at a time
+    for root in (blobstore.BLOB_ROOT, image_variants.VARIANTS_FOLDER):
+        for dirpath, _, filenames in os.walk(root):
+            for filename in filenames:
+                yield os.path.join(dirpath, filename)
+    if os.path.isdir(UPLOADS_FOLDER):
+        for entry in os.scandir(UPLOADS_FOLDER):
+            if entry.is_file():
+                yield os.path.join(UPLOADS_FOLDER, entry.name)
+
+
+# Resumable walk shared by sweeps in this process, so each one continues where the last stopped
+_file_walk = None
+
+
+def _sweep_files(report, deadline, dry_run, walk):
+    cutoff = time.time() - GC_GRACE_PERIOD
+    with db.connection() as conn:
+        for path in walk:
+            try:
+                mtime = os.path.getmtime(path)
+            except FileNotFoundError:
+                continue
+            name = os.path.basename(path)
+            if name.startswith(".upload-"):
+                # Spool left by an upload that never committed
+                kind, referenced = "spool_files", False
+            elif blobstore.is_blob(path):
+                kind = "blob_files"
+                referenced = conn.execute("SELECT 1 FROM images WHERE filepath = ? LIMIT 1", (path,)).fetchone()
+            elif os.path.dirname(path) == image_variants.VARIANTS_FOLDER:
+                kind = "variant_files"
+                referenced = conn.execute("SELECT 1 FROM image_variants WHERE filepath = ? LIMIT 1", (path,)).fetchone()
+            else:
+                if not conn.execute("SELECT 1 FROM images WHERE filepath = ? LIMIT 1", (path,)).fetchone():
+                    report["unreferenced_legacy_files"].append(path)
+                continue
+            if not referenced and mtime < cutoff:
+                report[kind] += 1
+                report["bytes"] += _size(path) if dry_run else _remove(path)
+            if time.monotonic() >= deadline:
+                return False
+    return True
+
+
+def _older_than(path, cutoff):
+    try:
+        return os.path.getmtime(path) < cutoff
+    except FileNotFoundError:
+        return False
+
+
+def _size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def _remove(path):
+    # Returns the bytes freed
+    size = _size(path)
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        return 0
+    return size
+
+
+_sweep_lock = threading.Lock()
+
+
+def sweep(dry_run=False, budget=None, batch_size=None):
+    """Run one sweep for at most ``budget`` seconds (None: until done) and return a report.
+
+    With ``dry_run`` nothing is changed; the report counts what a full sweep would reclaim.
+    """
+    global _file_walk
+    started = time.monotonic()
+    deadline = started + budget if budget is not None else float("inf")
+    batch_size = batch_size or GC_BATCH_SIZE
+    report = _new_report(dry_run)
+    with _sweep_lock:
+        done = _purge_image_rows(report, deadline, dry_run, batch_size)
+        done = _purge_tombstones(report, deadline, dry_run, batch_size) and done
+        if dry_run:
+            done = _sweep_files(report, deadline, dry_run, _candidate_files()) and done
+        else:
+            _file_walk = _file_walk or _candidate_files()
+            if _sweep_files(report, deadline, dry_run, _file_walk):
+                _file_walk = None
+            else:
+                done = False
+    report["complete"] = done
+    report["seconds"] = round(time.monotonic() - started, 3)
+    return report
+
+
+def _run_forever():
+    while True:
+        time.sleep(GC_INTERVAL)
+        try:
+            report = sweep(budget=GC_TIME_BUDGET)
+            reclaimed = report["image_rows"] + report["blob_files"] + report["variant_files"] + report["spool_files"]
+            if reclaimed or report["tombstones"]:
+                logging.info("Sweeper reclaimed %s rows/files, %s bytes, %s tombstones", reclaimed, report["bytes"], report["tombstones"])
+        except Exception:
+            logging.exception("Sweep failed")
+
+
+_started = False
+
+
+def start_background():
+    """Start the periodic sweeper thread once per process (no-op when GC_INTERVAL is 0)."""
+    global _started
+    if _started or GC_INTERVAL <= 0:
+        return
+    _started = True
+    threading.Thread(target=_run_forever, name="sweeper", daemon=True).start()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dry-run", action="store_true", help="report what would be reclaimed without changing anything")
+    parser.add_argument("--budget", type=float, default=None, help="stop after this many seconds (default: run to completion)")
+    args = parser.parse_args()
+    db.initial_setup()
+    print(json.dumps(sweep(dry_run=args.dry_run, budget=args.budget), indent=2))
@@ -0,0 +1,82 @@
+# uploads.py
+# Validates image uploads while the multipart body is still being parsed, so
+# an oversized or non-image file is rejected before the rest of it is read.
+from decouple import config
+from flask import Request
+from werkzeug.exceptions import RequestEntityTooLarge, UnsupportedMediaType
+import blobstore
+
+ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'webp'}
+MAX_UPLOAD_SIZE = config("MAX_UPLOAD_SIZE", default=15 * 1024 * 1024, cast=int)
+UPLOAD_SPOOL_THRESHOLD = config("UPLOAD_SPOOL_THRESHOLD", default=1024 * 1024, cast=int)
+
+# Leading bytes of each accepted image format
+SIGNATURES = [
+    (b"\x89PNG\r\n\x1a\n", "png"),
+    (b"\xff\xd8\xff", "jpeg"),
+    (b"GIF87a", "gif"),
+    (b"GIF89a", "gif"),
+]
+SNIFF_BYTES = 12
+
+
+def allowed_file(filename):
+    """Check if the given filename has an allowed extension."""
+    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+
+
+def sniff(header):
+    """Return the image format the leading bytes belong to, or None."""
+    for signature, kind in SIGNATURES:
+        if header.startswith(signature):
+            return kind
+    if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+        return "webp"
+    return None
+
+
+class _UploadGuard:
+    # Per-file check run on every chunk the multipart parser writes
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.header = b""
+
+    def __call__(self, blob, chunk):
+        if blob.size + len(chunk) > self.max_size:
+            blob.close()
+            raise RequestEntityTooLarge(f"Image exceeds the {self.max_size} byte limit")
+        if len(self.header) < SNIFF_BYTES:
+            self.header += chunk[:SNIFF_BYTES - len(self.header)]
+            if len(self.header) >= SNIFF_BYTES and sniff(self.header) is None:
+                blob.close()
+                raise UnsupportedMediaType("Only PNG, JPEG, GIF and WebP images are accepted")
+
+
+def check_image(image):
+    """Reject a parsed upload too short to have been sniffed while streaming."""
+    stream = image.stream
+    position = stream.tell()
+    stream.seek(0)
+    header = stream.read(SNIFF_BYTES)
+    stream.seek(position)
+    if sniff(header) is None:
+        raise UnsupportedMediaType("Only PNG, JPEG, GIF and WebP images are accepted")
+
+
+class UploadRequest(Request):
+    """Request class that streams file fields into blob store spools with size and type checks.
+
+    Requests larger than MAX_CONTENT_LENGTH are refused from the Content-Length
+    header alone, before any of the body is read.
+    """
+
+    # Endpoints whose file fields are data files (CSV, zips) rather than single images
+    data_upload_endpoints = set()
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if self.endpoint in self.data_upload_endpoints:
+            return super()._get_file_stream(total_content_length, content_type, filename, content_length)
+        if filename and not allowed_file(filename):
+            raise UnsupportedMediaType(f"File type not allowed: {filename}")
+        return blobstore.SpooledBlob(UPLOAD_SPOOL_THRESHOLD, check=_UploadGuard(MAX_UPLOAD_SIZE))